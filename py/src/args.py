@@ -1,6 +1,19 @@
 import argparse
 
 
+def frameskip(value: str) -> int:
+    """
+    How many frames to skip after each one drawn - "auto" is stored
+    as -1, meaning "skip frames when we're running behind"
+    """
+    if value == "auto":
+        return -1
+    n = int(value)
+    if n < 0:
+        raise argparse.ArgumentTypeError("frameskip must be >= 0 or 'auto'")
+    return n
+
+
 def parse_args(args):
     parser = argparse.ArgumentParser()
     parser.add_argument("rom")
@@ -10,9 +23,46 @@ def parse_args(args):
     parser.add_argument("-c", "--debug-cpu", action="store_true", default=False)
     parser.add_argument("-g", "--debug-gpu", action="store_true", default=False)
     parser.add_argument("-r", "--debug-ram", action="store_true", default=False)
+    parser.add_argument(
+        "--debug-refresh",
+        type=int,
+        default=10,
+        metavar="N",
+        help="With --debug-gpu, update the tile viewer every N frames",
+    )
     parser.add_argument("-H", "--headless", action="store_true", default=False)
     parser.add_argument("-S", "--silent", action="store_true", default=False)
     parser.add_argument("-t", "--turbo", action="store_true", default=False)
+    parser.add_argument(
+        "--no-fast-halt",
+        action="store_true",
+        default=False,
+        help="Step through HALT one LCD mode change at a time, rather than skipping to the next interrupt",
+    )
+    parser.add_argument(
+        "--idle-skip",
+        action="store_true",
+        default=False,
+        help="Detect loops which busy-wait on I/O registers, and skip ahead to when the value can next change",
+    )
+    parser.add_argument(
+        "--numpy",
+        action="store_true",
+        default=False,
+        help="Render graphics with NumPy (which needs to be installed) rather than pure Python",
+    )
+    parser.add_argument(
+        "--frameskip",
+        type=frameskip,
+        default=0,
+        metavar="N|auto",
+        help="Only draw one frame in every N+1, or with 'auto', skip drawing whenever the last frame took too long",
+    )
+    parser.add_argument(
+        "--screenshot",
+        metavar="FILE",
+        help="Save the last frame drawn to FILE (as a BMP) on exit - when headless, the last frame before --profile's limit is drawn just for this",
+    )
     parser.add_argument(
         "-p",
         "--profile",
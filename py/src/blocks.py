@@ -0,0 +1,610 @@
+"""
+Block compiler - translates a straight-line run of instructions into
+one Python function, with registers and flags held in local variables
+and the cycle count added up once per block instead of per instruction.
+The exception is anything which might touch I/O (or call a handler):
+the CPU's cycle counter is brought up to date first, so timers and LCD
+registers see the same time they would when stepping one at a time.
+
+Instructions that have a template below are inlined; anything else is
+run by calling the CPU's own handler, syncing registers around it.
+Anything that can change PC (jumps, calls, returns) or the CPU's state
+(HALT, STOP, EI, DI) ends the block. The common jumps are inlined too,
+so that loops like `DEC B; JR NZ` or `CP n; JR Z` run as one block
+with the flag test on a local, rather than handing over to a handler.
+
+A store which could switch ROM banks, write to I/O (which may schedule
+an event or raise an interrupt), or overwrite code we've compiled ends
+the block straight after it - decided at compile time when the address
+is a constant, or checked when the store happens when it isn't.
+
+Most ALU results have their flags overwritten by the next ALU op
+before anything looks at them, so any flag computation whose result is
+never read within the block (or written back at the end of it) is left
+out of the compiled code. This is only done for compiled blocks - the
+CPU's own handlers, which run everything outside of them, still work
+out every flag as they go.
+"""
+
+import re
+from typing import Callable, Dict, List, Optional, Set
+
+from .consts import *
+
+# The longest run of instructions we'll put in one block
+MAX_BLOCK = 32
+
+# Local variable name -> CPU attribute
+ATTRS = {
+    "A": "A",
+    "B": "B",
+    "C": "C",
+    "D": "D",
+    "E": "E",
+    "H": "H",
+    "L": "L",
+    "SP": "SP",
+    "FZ": "FLAG_Z",
+    "FN": "FLAG_N",
+    "FH": "FLAG_H",
+    "FC": "FLAG_C",
+}
+LOCALS_RE = re.compile(r"\b(" + "|".join(ATTRS) + r")\b")
+FLAGS_RE = re.compile(r"\b(FZ|FN|FH|FC)\b")
+FLAG_SET_RE = re.compile(r"^(FZ|FN|FH|FC) = (.*)$")
+RAM_RE = re.compile(r"ram\[([^\]]+)\]")
+
+# Instructions which end a block, because they (may) change PC or
+# change how the CPU ticks
+BLOCK_ENDS = {
+    0x10,  # STOP
+    0x18,  # JR n
+    0x20,  # JR NZ,n
+    0x28,  # JR Z,n
+    0x30,  # JR NC,n
+    0x38,  # JR C,n
+    0x76,  # HALT
+    0xC0,  # RET NZ
+    0xC2,  # JP NZ,nn
+    0xC3,  # JP nn
+    0xC4,  # CALL NZ,nn
+    0xC7,  # RST 00
+    0xC8,  # RET Z
+    0xC9,  # RET
+    0xCA,  # JP Z,nn
+    0xCC,  # CALL Z,nn
+    0xCD,  # CALL nn
+    0xCF,  # RST 08
+    0xD0,  # RET NC
+    0xD2,  # JP NC,nn
+    0xD3,  # ERR
+    0xD4,  # CALL NC,nn
+    0xD7,  # RST 10
+    0xD8,  # RET C
+    0xD9,  # RETI
+    0xDA,  # JP C,nn
+    0xDB,  # ERR
+    0xDC,  # CALL C,nn
+    0xDD,  # ERR
+    0xDF,  # RST 18
+    0xE3,  # ERR
+    0xE4,  # ERR
+    0xE7,  # RST 20
+    0xE9,  # JP HL
+    0xEB,  # ERR
+    0xEC,  # ERR
+    0xED,  # ERR
+    0xEF,  # RST 28
+    0xF3,  # DI
+    0xF4,  # ERR
+    0xF7,  # RST 30
+    0xFB,  # EI
+    0xFC,  # EXIT 0
+    0xFD,  # EXIT 1
+    0xFF,  # RST 38
+}
+
+
+def _get(reg: str) -> str:
+    return "ram[H << 8 | L]" if reg == "[HL]" else reg
+
+
+def _set(reg: str, val: str) -> str:
+    return f"ram[H << 8 | L] = {val}" if reg == "[HL]" else f"{reg} = {val}"
+
+
+# Each template is the body of the handler with the same opcode, with
+# `self.X` replaced by local `X` and `{n}` standing in for the operand
+TEMPLATES: Dict[int, str] = {}
+CB_TEMPLATES: Dict[int, str] = {}
+
+# Templates which set PC themselves, so the block doesn't need to
+JUMPS: Set[int] = set()
+
+# <editor-fold description="3.3.1 8-Bit Loads">
+for base, reg in enumerate(GEN_REGS):
+    TEMPLATES[0x06 + base * 8] = _set(reg, "{n}")
+for base, reg_to in enumerate(GEN_REGS):
+    for offset, reg_from in enumerate(GEN_REGS):
+        if reg_from == "[HL]" and reg_to == "[HL]":
+            continue
+        TEMPLATES[0x40 + base * 8 + offset] = _set(reg_to, _get(reg_from))
+TEMPLATES[0x0A] = "A = ram[B << 8 | C]"
+TEMPLATES[0x1A] = "A = ram[D << 8 | E]"
+TEMPLATES[0xFA] = "A = ram[{n}]"
+TEMPLATES[0x02] = "ram[B << 8 | C] = A"
+TEMPLATES[0x12] = "ram[D << 8 | E] = A"
+TEMPLATES[0xEA] = "ram[{n}] = A"
+TEMPLATES[0xF2] = "A = ram[0xFF00 + C]"
+TEMPLATES[0xE2] = "ram[0xFF00 + C] = A"
+for op, load, step in [
+    (0x3A, True, -1),
+    (0x32, False, -1),
+    (0x2A, True, 1),
+    (0x22, False, 1),
+]:
+    TEMPLATES[op] = "\n".join(
+        [
+            "hl = H << 8 | L",
+            "A = ram[hl]" if load else "ram[hl] = A",
+            f"hl += {step}",
+            "H = hl >> 8 & 0xFF",
+            "L = hl & 0xFF",
+        ]
+    )
+TEMPLATES[0xE0] = "ram[0xFF00 + {n}] = A"
+TEMPLATES[0xF0] = "A = ram[0xFF00 + {n}]"
+# </editor-fold>
+
+# <editor-fold description="3.3.2 16-Bit Loads">
+TEMPLATES[0x01] = "B = {hi}\nC = {lo}"
+TEMPLATES[0x11] = "D = {hi}\nE = {lo}"
+TEMPLATES[0x21] = "H = {hi}\nL = {lo}"
+TEMPLATES[0x31] = "SP = {n}"
+TEMPLATES[0xF9] = "SP = H << 8 | L"
+for op, hi, lo in [(0xC5, "B", "C"), (0xD5, "D", "E"), (0xE5, "H", "L")]:
+    TEMPLATES[op] = f"ram[SP - 1] = {hi}\nram[SP - 2] = {lo}\nSP -= 2"
+    TEMPLATES[op - 4] = f"{lo} = ram[SP]\n{hi} = ram[SP + 1]\nSP += 2"
+TEMPLATES[0xF5] = "\n".join(
+    [
+        "ram[SP - 1] = A",
+        "ram[SP - 2] = (FZ or 0) << 7 | (FN or 0) << 6 | (FH or 0) << 5 | (FC or 0) << 4",
+        "SP -= 2",
+    ]
+)
+TEMPLATES[0xF1] = "\n".join(
+    [
+        "v = ram[SP]",
+        "A = ram[SP + 1]",
+        "FZ = bool(v & 0b10000000)",
+        "FN = bool(v & 0b01000000)",
+        "FH = bool(v & 0b00100000)",
+        "FC = bool(v & 0b00010000)",
+        "SP += 2",
+    ]
+)
+# </editor-fold>
+
+# <editor-fold description="3.3.3 8-Bit Arithmetic">
+ALU = {
+    # ADD
+    0x80: """
+        FC = A + v > 0xFF
+        FH = (A & 0x0F) + (v & 0x0F) > 0x0F
+        FN = False
+        A = (A + v) & 0xFF
+        FZ = A == 0
+    """,
+    # ADC
+    0x88: """
+        c = int(FC)
+        FC = A + v + c > 0xFF
+        FH = (A & 0x0F) + (v & 0x0F) + c > 0x0F
+        FN = False
+        A = (A + v + c) & 0xFF
+        FZ = A == 0
+    """,
+    # SUB
+    0x90: """
+        FC = A < v
+        FH = (A & 0x0F) < (v & 0x0F)
+        A = (A - v) & 0xFF
+        FZ = A == 0
+        FN = True
+    """,
+    # SBC
+    0x98: """
+        c = int(FC)
+        res = A - v - c
+        byte1 = A
+        FC = A < v + c
+        A = (A - v - c) & 0xFF
+        FZ = A == 0
+        FN = True
+        FH = ((byte1 ^ v ^ (res & 0xFF)) & (1 << 4)) != 0
+    """,
+    # AND
+    0xA0: """
+        A &= v
+        FZ = A == 0
+        FN = False
+        FH = True
+        FC = False
+    """,
+    # XOR
+    0xA8: """
+        A ^= v
+        FZ = A == 0
+        FN = False
+        FH = False
+        FC = False
+    """,
+    # OR
+    0xB0: """
+        A |= v
+        FZ = A == 0
+        FN = False
+        FH = False
+        FC = False
+    """,
+    # CP
+    0xB8: """
+        FZ = A == v
+        FN = True
+        FH = (A & 0x0F) < (v & 0x0F)
+        FC = A < v
+    """,
+}
+for base, body in ALU.items():
+    body = "\n".join(line.strip() for line in body.strip().split("\n"))
+    for offset, reg in enumerate(GEN_REGS):
+        TEMPLATES[base + offset] = f"v = {_get(reg)}\n{body}"
+    # the immediate versions, eg ADD A,n = 0xC6
+    TEMPLATES[base + 0x46] = f"v = {{n}}\n{body}"
+
+for base, reg in enumerate(GEN_REGS):
+    TEMPLATES[0x04 + base * 8] = "\n".join(
+        [
+            f"v = {_get(reg)}",
+            "FH = v & 0x0F == 0x0F",
+            "v = (v + 1) & 0xFF",
+            _set(reg, "v"),
+            "FZ = v == 0",
+            "FN = False",
+        ]
+    )
+    TEMPLATES[0x05 + base * 8] = "\n".join(
+        [
+            f"v = {_get(reg)}",
+            "v = (v - 1) & 0xFF",
+            "FH = v & 0x0F == 0x0F",
+            _set(reg, "v"),
+            "FZ = v == 0",
+            "FN = True",
+        ]
+    )
+# </editor-fold>
+
+# <editor-fold description="3.3.4 16-Bit Arithmetic">
+for op, hi, lo in [(0x00, "B", "C"), (0x10, "D", "E"), (0x20, "H", "L")]:
+    TEMPLATES[op + 0x09] = "\n".join(
+        [
+            "hl = H << 8 | L",
+            f"v = {hi} << 8 | {lo}",
+            "FH = (hl & 0x0FFF) + (v & 0x0FFF) > 0x0FFF",
+            "FC = hl + v > 0xFFFF",
+            "hl = (hl + v) & 0xFFFF",
+            "H = hl >> 8",
+            "L = hl & 0xFF",
+            "FN = False",
+        ]
+    )
+    for ins, step in [(0x03, "+"), (0x0B, "-")]:
+        TEMPLATES[op + ins] = "\n".join(
+            [
+                f"v = (({hi} << 8 | {lo}) {step} 1) & 0xFFFF",
+                f"{hi} = v >> 8",
+                f"{lo} = v & 0xFF",
+            ]
+        )
+TEMPLATES[0x39] = "\n".join(
+    [
+        "hl = H << 8 | L",
+        "FH = (hl & 0x0FFF) + (SP & 0x0FFF) > 0x0FFF",
+        "FC = hl + SP > 0xFFFF",
+        "hl = (hl + SP) & 0xFFFF",
+        "H = hl >> 8",
+        "L = hl & 0xFF",
+        "FN = False",
+    ]
+)
+TEMPLATES[0x33] = "SP = (SP + 1) & 0xFFFF"
+TEMPLATES[0x3B] = "SP = (SP - 1) & 0xFFFF"
+# </editor-fold>
+
+# <editor-fold description="3.3.5 Miscellaneous">
+TEMPLATES[0x00] = "pass"
+TEMPLATES[0x2F] = "A ^= 0xFF\nFN = True\nFH = True"
+TEMPLATES[0x3F] = "FN = False\nFH = False\nFC = not FC"
+TEMPLATES[0x37] = "FN = False\nFH = False\nFC = True"
+# </editor-fold>
+
+# <editor-fold description="3.3.6 Rotates & Shifts">
+TEMPLATES[0x07] = "\n".join(
+    [
+        "FC = (A & 0b10000000) != 0",
+        "A = ((A << 1) | (A >> 7)) & 0xFF",
+        "FZ = False\nFN = False\nFH = False",
+    ]
+)
+TEMPLATES[0x17] = "\n".join(
+    [
+        "c = FC",
+        "FC = (A & 0b10000000) != 0",
+        "A = ((A << 1) | c) & 0xFF",
+        "FZ = False\nFN = False\nFH = False",
+    ]
+)
+TEMPLATES[0x0F] = "\n".join(
+    [
+        "FC = (A & 0b00000001) != 0",
+        "A = ((A >> 1) | (A << 7)) & 0xFF",
+        "FZ = False\nFN = False\nFH = False",
+    ]
+)
+TEMPLATES[0x1F] = "\n".join(
+    [
+        "c = FC",
+        "FC = (A & 0b00000001) != 0",
+        "A = (A >> 1) | (c << 7)",
+        "FZ = False\nFN = False\nFH = False",
+    ]
+)
+# </editor-fold>
+
+# <editor-fold description="3.3.7 Bit Opcodes">
+for b in range(8):
+    for offset, reg in enumerate(GEN_REGS):
+        CB_TEMPLATES[0x40 + b * 8 + offset] = "\n".join(
+            [
+                f"FZ = not bool({_get(reg)} & (1 << {b}))",
+                "FN = False",
+                "FH = True",
+            ]
+        )
+        CB_TEMPLATES[0x80 + b * 8 + offset] = _set(
+            reg, f"{_get(reg)} & {(0x01 << b) ^ 0xFF}"
+        )
+        CB_TEMPLATES[0xC0 + b * 8 + offset] = _set(reg, f"{_get(reg)} | {0x01 << b}")
+# </editor-fold>
+
+# <editor-fold description="3.3.8 Jumps">
+# `{next}` is the address of the following instruction
+CONDITIONS = {0x00: "not FZ", 0x08: "FZ", 0x10: "not FC", 0x18: "FC"}
+TEMPLATES[0x18] = "self.PC = {next} + {n}"
+TEMPLATES[0xC3] = "self.PC = {n}"
+TEMPLATES[0xE9] = "self.PC = H << 8 | L"
+for offset, cond in CONDITIONS.items():
+    TEMPLATES[0x20 + offset] = f"self.PC = {{next}} + {{n}} if {cond} else {{next}}"
+    TEMPLATES[0xC2 + offset] = f"self.PC = {{n}} if {cond} else {{next}}"
+JUMPS.update([0x18, 0xC3, 0xE9, 0x20, 0x28, 0x30, 0x38, 0xC2, 0xCA, 0xD2, 0xDA])
+# </editor-fold>
+
+# <editor-fold description="3.3.9 Calls">
+TEMPLATES[0xCD] = "\n".join(
+    [
+        "ram[SP - 1] = {next} >> 8",
+        "ram[SP - 2] = {next} & 0xFF",
+        "SP -= 2",
+        "self.PC = {n}",
+    ]
+)
+JUMPS.add(0xCD)
+# </editor-fold>
+
+# <editor-fold description="3.3.11 Returns">
+TEMPLATES[0xC9] = "self.PC = ram[SP + 1] << 8 | ram[SP]\nSP += 2"
+JUMPS.add(0xC9)
+# </editor-fold>
+
+# Where each instruction stores to memory, as expressions which give
+# the address(es) once its code has run. Handlers (rather than
+# templates) have to be looked at through `self`.
+STORES: Dict[int, List[str]] = {
+    0x02: ["B << 8 | C"],
+    0x12: ["D << 8 | E"],
+    0x22: ["hl - 1"],
+    0x32: ["hl + 1"],
+    0xE2: ["0xFF00 + C"],
+    0xEA: ["{n}"],
+    0xE0: ["0xFF00 + {n}"],
+    0x08: ["{n}", "{n} + 1"],
+}
+for op in [0x34, 0x35, 0x36, *range(0x70, 0x76), 0x77]:
+    STORES[op] = ["H << 8 | L"]
+for op in [0xC5, 0xD5, 0xE5, 0xF5]:
+    STORES[op] = ["SP", "SP + 1"]
+CB_STORES: Dict[int, List[str]] = {}
+for op in range(0x06, 0x100, 0x08):
+    if op < 0x40:
+        CB_STORES[op] = ["self.H << 8 | self.L"]
+    elif op >= 0x80:
+        CB_STORES[op] = ["H << 8 | L"]
+
+
+def ends_block(addr: int) -> bool:
+    """
+    Whether a store to `addr` could change what code runs next or when
+    - a ROM bank switch, or an I/O / IE register write
+
+    >>> ends_block(0x2000), ends_block(0xC000), ends_block(0xFF40), ends_block(0xFF80)
+    (True, False, True, False)
+    """
+    return addr < 0x8000 or 0xFF00 <= addr < 0xFF80 or addr >= 0xFFFF
+
+
+def constant(expr: str) -> Optional[int]:
+    """
+    The value of `expr`, if it doesn't depend on any registers
+
+    >>> constant("0xFF00 + 68"), constant("H << 8 | L")
+    (65348, None)
+    """
+    try:
+        return eval(expr, {"__builtins__": {}})
+    except NameError:
+        return None
+
+
+def drop_dead_flags(lines: List[str]) -> List[str]:
+    """
+    Remove assignments to flags which are overwritten before they are
+    next read - working backwards from the end of the block, where
+    nothing is read unless it's written back to the CPU.
+
+    >>> drop_dead_flags(["FZ = A == 0", "FC = False", "FZ = True", "self.FLAG_Z = FZ"])
+    ['FZ = True', 'self.FLAG_Z = FZ']
+    """
+    live: Set[str] = set()
+    out: List[str] = []
+    for line in reversed(lines):
+        m = FLAG_SET_RE.match(line)
+        if m:
+            flag, val = m.groups()
+            # reading RAM can have side effects (eg reading TIMA catches
+            # the timer up), so those have to stay even if unused
+            if flag not in live and "ram[" not in val:
+                continue
+            live.discard(flag)
+            live.update(FLAGS_RE.findall(val))
+        else:
+            live.update(FLAGS_RE.findall(line))
+        out.append(line)
+    out.reverse()
+    return out
+
+
+def compile_block(cpu, start: int, limit: int = MAX_BLOCK) -> Callable[[], int]:
+    """
+    Translate the instructions starting at `start` into a function which
+    runs them all and returns how many machine cycles they took (or the
+    remainder, if it has already added some of them to `cpu.cycle`).
+    """
+    src = cpu.ram
+    ns = {"self": cpu, "ram": cpu.ram, "ends_block": ends_block}
+    lines: List[str] = []
+    loaded: Set[str] = set()
+    cycles = 0
+    # how many of `cycles` have already been added to cpu.cycle
+    counted = 0
+    # when the last instruction starts, for tick_block's budget
+    last_start = 0
+    pc = start
+    pc_set = False
+
+    def writeback(indent: str = "") -> List[str]:
+        return [f"{indent}self.{ATTRS[name]} = {name}" for name in sorted(loaded)]
+
+    def sync() -> None:
+        # write back any registers we're holding in locals
+        lines.extend(writeback())
+        loaded.clear()
+
+    def sync_cycle() -> None:
+        nonlocal counted
+        if cycles > counted:
+            lines.append(f"self.cycle += {(cycles - counted) >> 2}")
+            counted = cycles
+
+    for n in range(limit):
+        ins = src[pc]
+        if ins == 0xCB:
+            op = src[pc + 1]
+            fn, kind, ins_cycles = cpu.cb_op_table[op]
+            template = CB_TEMPLATES.get(op)
+            param = None
+            next_pc = pc + 2
+        else:
+            fn, kind, ins_cycles = cpu.op_table[ins]
+            # if the handler has been wrapped (eg to detect idle loops),
+            # the wrapper has to run, so don't inline it
+            template = TEMPLATES.get(ins) if fn is cpu.ops[ins] else None
+            if kind == 0:
+                param = None
+                next_pc = pc + 1
+            elif kind == 3:
+                param = src[pc + 1] | src[pc + 2] << 8
+                next_pc = pc + 3
+            else:
+                param = src[pc + 1]
+                if kind == 2 and param > 128:
+                    param -= 256
+                next_pc = pc + 2
+            # LDH [01],A prints to the console, let the handler do that
+            if ins == 0xE0 and param == 0x01:
+                template = None
+        stores = CB_STORES.get(op, []) if ins == 0xCB else STORES.get(ins, [])
+        stores = [addr.format(n=param) for addr in stores]
+        last_start = cycles
+
+        if template is not None:
+            code = template.format(
+                n=param, hi=(param or 0) >> 8, lo=(param or 0) & 0xFF, next=next_pc
+            )
+            # anything which isn't a plain RAM / ROM address might be
+            # an I/O register, which needs to know the current cycle
+            if any(
+                not addr.isdigit() or int(addr) >= 0xFF00
+                for addr in RAM_RE.findall(code)
+            ):
+                sync_cycle()
+            for name in sorted(set(LOCALS_RE.findall(code)) - loaded):
+                lines.append(f"{name} = self.{ATTRS[name]}")
+                loaded.add(name)
+            lines.extend(code.split("\n"))
+            pc_set = ins in JUMPS
+        else:
+            sync()
+            sync_cycle()
+            ns[f"op{n}"] = fn
+            lines.append(f"self.PC = {next_pc}")
+            lines.append(f"op{n}()" if param is None else f"op{n}({param})")
+            pc_set = True
+        cycles += ins_cycles
+        pc = next_pc
+
+        if ins in BLOCK_ENDS:
+            break
+        known = [constant(addr) for addr in stores]
+        if stores and None not in known:
+            if any(ends_block(addr) for addr in known):
+                break
+            # plain RAM, which only matters if we've compiled code from it
+            checks = []
+            check = any(0xC000 <= addr < 0xFE00 or addr >= 0xFF80 for addr in known)
+        else:
+            # we only find out where it went when it happens
+            checks = [f"ends_block({addr})" for addr in stores]
+            check = bool(stores)
+        if check:
+            lines.append("if " + " or ".join(checks + ["self._code_written"]) + ":")
+            lines.append("    self._code_written = False")
+            lines.extend(writeback("    "))
+            if not pc_set:
+                lines.append(f"    self.PC = {pc}")
+            lines.append(f"    return {(cycles - counted) >> 2}")
+        # don't run off the end of the memory region we started in
+        if pc >> 12 != start >> 12 or pc >= 0xFFFF:
+            break
+
+    sync()
+    if not pc_set:
+        lines.append(f"self.PC = {pc}")
+    lines.append(f"return {(cycles - counted) >> 2}")
+
+    body = "\n".join("    " + line for line in drop_dead_flags(lines))
+    exec(f"def block():\n{body}", ns)
+    block = ns["block"]
+    block.end = pc
+    block.last_start = last_start >> 2
+    return block
@@ -36,18 +36,28 @@ class Buttons:
         self.start = False
         self.select = False
 
-    def tick(self) -> None:
-        self.cycle += 1
-        self.update_buttons()
-        if self.need_interrupt:
-            self.cpu.stop = False
-            self.cpu.interrupt(Interrupt.JOYPAD)
-            self.need_interrupt = False
-        if self.cycle % 17556 == 20:
+        self.next_event = 20
+        cpu.ram.io_write_hooks[Mem.JOYP] = self.update_buttons
+
+    def tick(self, now: int) -> None:
+        self.cycle = now
+        if self.cycle >= self.next_event:
             self.handle_inputs()
+            # re-latch JOYP so that the game sees the new button state
+            self.cpu.ram[Mem.JOYP] = self.cpu.ram[Mem.JOYP]
+            if self.need_interrupt:
+                self.cpu.stop = False
+                self.cpu.interrupt(Interrupt.JOYPAD)
+                self.need_interrupt = False
+            # poll again at the same point in the next frame
+            self.next_event = self.cycle + 1 + (20 - self.cycle - 1) % 17556
 
-    def update_buttons(self) -> None:
-        JOYP = ~self.cpu.ram[Mem.JOYP]
+    def update_buttons(self, val: int) -> int:
+        """
+        The game writes to JOYP to select the d-pad or the buttons,
+        and then reads back which of the selected ones are held
+        """
+        JOYP = ~val
         JOYP &= 0xF0
         if JOYP & Joypad.MODE_DPAD:
             if self.up:
@@ -67,7 +77,7 @@ class Buttons:
                 JOYP |= Joypad.START
             if self.select:
                 JOYP |= Joypad.SELECT
-        self.cpu.ram[Mem.JOYP] = ~JOYP
+        return ~JOYP & 0xFF
 
     def handle_inputs(self) -> None:
         if self.headless:
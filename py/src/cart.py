@@ -51,9 +51,11 @@ def parse_ram_size(val: int) -> int:
 
 
 class Cart:
-    def __init__(self, rom: str) -> None:
-        with open(rom, "rb") as fp:
-            self.data = fp.read()
+    def __init__(self, rom: str, data: Optional[bytes] = None) -> None:
+        if data is None:
+            with open(rom, "rb") as fp:
+                data = fp.read()
+        self.data = data
 
         self.rsts: str
         self.init: Tuple[int]
@@ -113,11 +115,28 @@ class Cart:
         if header_checksum != 0:
             raise HeaderChecksumFailed(header_checksum)
 
+        # battery-backed RAM on the cart, if it has any
+        self.ram = bytearray(self.ram_size)
+
+    @classmethod
+    def blank(cls) -> "Cart":
+        """
+        A 32KB ROM-only cart full of zeros (NOPs), with just enough of a
+        header to pass the checks - for trying out the CPU in doctests
+
+        >>> cart = Cart.blank()
+        >>> cart.cart_type, cart.rom_size, cart.ram_size
+        (<CartType.ROM_ONLY: 0>, 32768, 0)
+        """
+        logo = b"\xff" * 21 + b"\x5b"  # only the sum is checked
+        header = bytes(0x33) + b"\xe7"  # ...which makes this the checksum
+        return cls("<blank>", bytes(0x104) + logo + header + bytes(0x7EB2))
+
     def __str__(self) -> str:
         return "\n".join(
             [
                 f"{k}: {v}"
                 for k, v in self.__dict__.items()
-                if k not in {"data", "logo", "init", "rsts"}
+                if k not in {"data", "ram", "logo", "init", "rsts"}
             ]
         )
@@ -1,5 +1,6 @@
 import sdl2
 import time
+from typing import Callable, Optional
 from .buttons import Buttons
 from .errors import Timeout
 
@@ -13,15 +14,26 @@ class Clock:
         self.profile = profile
         self.turbo = turbo
         self.last_frame_start = 0
+        self.next_event = 20
 
-    def tick(self):
-        self.cycle += 1
+        # Whether the last frame took longer than 1/60th of a second
+        self.behind = False
+
+        # Called at the start of the last frame before the frame limit
+        # (which is frame profile+1, as we only stop when the next one starts)
+        self.on_last_frame: Optional[Callable[[], None]] = None
+
+    def tick(self, now: int):
+        self.cycle = now
 
         # Do a whole frame's worth of sleeping at the start of each frame
-        if self.cycle % 17556 == 20:
+        if self.cycle >= self.next_event:
+            self.next_event = self.cycle + 1 + (20 - self.cycle - 1) % 17556
+
             # Sleep if we have time left over
             time_spent = sdl2.SDL_GetTicks() - self.last_frame_start
             sleep_for = (1000 / 60) - time_spent
+            self.behind = sleep_for < 0
             if sleep_for > 0 and not self.turbo and not self.buttons.turbo:
                 sdl2.SDL_Delay(int(sleep_for))
             self.last_frame_start = sdl2.SDL_GetTicks()
@@ -32,3 +44,9 @@ class Clock:
                 raise Timeout(self.profile, duration)
 
             self.frame += 1
+            if (
+                self.on_last_frame
+                and self.profile != 0
+                and self.frame == self.profile + 1
+            ):
+                self.on_last_frame()
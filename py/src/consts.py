@@ -74,3 +74,7 @@ class Interrupt:
     TIMER = 1 << 2
     SERIAL = 1 << 3
     JOYPAD = 1 << 4
+
+
+# Registers in the order that opcodes encode them
+GEN_REGS = ["B", "C", "D", "E", "H", "L", "[HL]", "A"]
@@ -1,35 +1,42 @@
-from enum import Enum
-from typing import Optional
+from operator import attrgetter
+from typing import Callable, Dict, Optional, Tuple
 import sys
 from textwrap import dedent
 
 from .errors import UnitTestPassed, UnitTestFailed
+from .cart import Cart
 from .ram import RAM
 from .consts import *
-
-
-class Reg(Enum):
-    A = "A"
-    B = "B"
-    C = "C"
-    D = "D"
-    E = "E"
-    F = "F"
-    H = "H"
-    L = "L"
-
-    BC = "BC"
-    DE = "DE"
-    AF = "AF"
-    HL = "HL"
-
-    SP = "SP"
-    PC = "PC"
-
-    MEM_AT_HL = "MEM_AT_HL"
-
-
-GEN_REGS = ["B", "C", "D", "E", "H", "L", "[HL]", "A"]
+from .blocks import compile_block
+
+# The register file - stored in slots on the CPU, so that every access
+# is a direct offset into the object rather than a dict lookup
+REGISTERS = (
+    "A",
+    "B",
+    "C",
+    "D",
+    "E",
+    "H",
+    "L",
+    "SP",
+    "PC",
+    "FLAG_Z",
+    "FLAG_N",
+    "FLAG_H",
+    "FLAG_C",
+)
+_read_registers = attrgetter(*REGISTERS)
+
+
+def _reg(reg: str) -> str:
+    """
+    The expression for one of GEN_REGS, for use in generated opcodes
+
+    >>> _reg("B"), _reg("[HL]")
+    ('self.B', 'self.ram[self.H << 8 | self.L]')
+    """
+    return "self.ram[self.H << 8 | self.L]" if reg == "[HL]" else f"self.{reg}"
 
 
 class OpNotImplemented(Exception):
@@ -46,18 +53,51 @@ def opcode(name: str, cycles: int, args: str = ""):
     return dec
 
 
+# Operand kinds, as stored in the predecoded dispatch tables
+ARG_NONE = 0
+ARG_U8 = 1  # "B" - unsigned byte
+ARG_I8 = 2  # "b" - signed byte
+ARG_U16 = 3  # "H" - little-endian word
+ARG_KINDS = {"": ARG_NONE, "B": ARG_U8, "b": ARG_I8, "H": ARG_U16}
+
+# Instructions which can appear in a busy-wait loop without making it
+# unsafe to skip - they only read memory / registers and set A or flags
+# in a way that gives the same result every time round. Reads through
+# [HL] aren't included, as HL could point anywhere (eg at LY or DIV),
+# and the same loop could be entered with a different HL next time.
+IDLE_SAFE_OPS = {
+    0x00,  # NOP
+    0xF0,  # LDH A,[n]
+    0xFA,  # LD A,[nn]
+    0xFE,  # CP n
+    0xE6,  # AND n
+    *(op for op in range(0xB8, 0xC0) if op != 0xBE),  # CP r
+}
+IDLE_SAFE_CB_OPS = {op for op in range(0x40, 0x80) if op & 7 != 6}  # BIT b,r
+IDLE_JUMPS = {0x18, 0x20, 0x28, 0x30, 0x38}  # JR n, JR cc,n
+
+
 class CPU:
+    __slots__ = REGISTERS + ("__dict__",)
+
     # <editor-fold description="Init">
-    def __init__(self, ram: RAM, debug=False) -> None:
+    def __init__(self, ram: Optional[RAM] = None, debug=False, idle_skip=False) -> None:
+        # with no RAM (eg in doctests), run on an empty cart
+        if ram is None:
+            ram = RAM(Cart.blank())
         self.ram = ram
         self.interrupts = True
+        # interrupts and (IE & IF) - only recalculated when one of those
+        # changes, so that most instructions don't need to look at them
+        self.interrupt_pending = False
         self.halt = False
         self.stop = False
         self.cycle = 0
+        self.next_event = sys.maxsize
+        self._timer_event = sys.maxsize
+        self._dma_end = sys.maxsize
         self._nopslide = 0
         self._debug = debug
-        self._debug_str = ""
-        self._owed_cycles = 0
 
         # registers
         # boot rom should set these to defaults
@@ -79,9 +119,79 @@ class CPU:
         self.FLAG_H: bool = False  # True   # half-carry
         self.FLAG_C: bool = False  # True   # carry
 
+        # Timer registers aren't stored anywhere - they are derived from
+        # the cycle counter when read, relative to the last time they
+        # were reset / written
+        self._div_base = 0
+        self._tima_base = 0
+        self._tima_base_cycle = 0
+        ram.io_read_hooks[Mem.DIV] = self._read_div
+        ram.io_read_hooks[Mem.TIMA] = self._read_tima
+        ram.io_write_hooks[Mem.DIV] = self._write_div
+        ram.io_write_hooks[Mem.TIMA] = self._write_tima
+        ram.io_write_hooks[Mem.TAC] = self._write_tac
+        ram.io_write_hooks[Mem.DMA] = self._write_dma
+        ram.io_write_hooks[Mem.IF] = self._write_if
+        ram.io_write_hooks[Mem.IE] = self._write_ie
+        self._update_interrupt_pending()
+
         self.ops = [getattr(self, "op%02X" % n) for n in range(0x00, 0xFF + 1)]
         self.cb_ops = [getattr(self, "opCB%02X" % n) for n in range(0x00, 0xFF + 1)]
 
+        # Predecoded dispatch tables - (handler, operand kind, cycles)
+        # for each opcode, so that the hot loop never has to look at
+        # the handler's metadata
+        self.op_table = [(fn, ARG_KINDS[fn.args], fn.cycles) for fn in self.ops]
+        self.cb_op_table = [(fn, ARG_KINDS[fn.args], fn.cycles) for fn in self.cb_ops]
+
+        # Busy-wait loop detection - relative jumps are swapped for
+        # versions which check for idle loops, so that it costs nothing
+        # when turned off
+        self.idle_skip = idle_skip
+        self.idle_loops_skipped = 0
+        self.idle_cycles_skipped = 0
+        self._idle_loops: Dict[Tuple[int, int], Tuple[int, bool]] = {}
+        self._idle_armed: Optional[int] = None
+        self._until = 0
+        if idle_skip:
+            for n in IDLE_JUMPS:
+                fn, kind, cycles = self.op_table[n]
+                self.op_table[n] = (self._idle_jump(fn), kind, cycles)
+
+        # Compiled blocks, keyed by address (plus ROM bank for the
+        # switchable bank). Blocks in RAM are thrown away whenever any
+        # of the code they were compiled from is written to.
+        self._rom_blocks: Dict[int, Callable[[], int]] = {}
+        self._ram_blocks: Dict[int, Callable[[], int]] = {}
+        ram.code_write_hook = self._flush_ram_blocks
+        # Set when compiled code is written to, so that a block which
+        # does the writing knows to stop before it runs stale code
+        self._code_written = False
+        # When tracing, we want to see every instruction individually
+        self._step = self.tick_instructions if debug else self.tick_block
+
+    def disassemble(self, pc: int) -> str:
+        """
+        Render the instruction at `pc` as text, eg "LD A,$42". This is
+        only needed for tracing / dumping, so it is never called from
+        the hot path unless debugging is enabled.
+        """
+        src = self.ram
+        if src[pc] == 0xCB:
+            return self.cb_ops[src[pc + 1]].name
+
+        cmd = self.ops[src[pc]]
+        if cmd.args == "B":
+            return cmd.name.replace("n", "$%02X" % src[pc + 1])
+        elif cmd.args == "b":
+            param = src[pc + 1]
+            if param > 128:
+                return cmd.name.replace("n", "%d" % (param - 256))
+            return cmd.name.replace("n", "+%d" % param)
+        elif cmd.args == "H":
+            return cmd.name.replace("nn", "$%04X" % (src[pc + 1] | src[pc + 2] << 8))
+        return cmd.name
+
     def dump(self, pc: int, cmd_str: str) -> str:
         ien = self.ram[Mem.IE]
         ifl = self.ram[Mem.IF]
@@ -131,54 +241,134 @@ class CPU:
         handler for this interrupt is enabled (and interrupts in general
         are enabled), then the interrupt handler will be called.
         """
-        self.ram[Mem.IF] |= i
+        self.ram[Mem.IF] |= i  # updates interrupt_pending
         self.halt = False  # interrupts interrupt HALT state
 
-    def tick(self) -> None:
-        self.tick_dma()
-        self.tick_clock()
-        self.tick_interrupts()
-        if self.halt:
-            return
-        if self.stop:
-            return
-        self.tick_instructions()
+    def tick(self, until: int) -> None:
+        """
+        Run whole instructions until we reach cycle `until` (or just
+        past it, if the last instruction was a long one), then bring
+        DMA up to date.
+        """
+        self._until = until
+        while self.cycle < self._until:
+            if self.cycle >= self.next_event:
+                self.tick_clock()
+            if self.interrupt_pending:
+                self.tick_interrupts()
+            if self.halt or self.stop:
+                # nothing can wake us up until the next event
+                self.cycle = min(self._until, self.next_event)
+                continue
+            # nb: not `self.cycle += ...`, because skipping an idle loop
+            # moves self.cycle forward from inside the instruction
+            cycles = self._step()
+            self.cycle += cycles
+        if self.cycle >= self.next_event:
+            self.tick_clock()
+
+    def end_tick_by(self, cycle: int) -> None:
+        """
+        Make the current tick() return by `cycle` - for when something
+        else has just had an event scheduled sooner than it expected
+        """
+        self._until = min(self._until, cycle)
 
-    def tick_dma(self) -> None:
+    def _write_dma(self, val: int) -> int:
         """
-        If there is a non-zero value in ram[Mem.DMA], eg 0x42, then
-        we should copy memory from eg 0x4200 to OAM space.
+        Writing eg 0x42 to Mem.DMA copies 0x4200-0x429F to OAM. We copy
+        it all at once, and then lock OAM for the 160 cycles that the
+        real transfer takes, so nobody can see that it was instant.
         """
-        # TODO: DMA should take 26 cycles, during which main RAM is inaccessible
-        if self.ram[Mem.DMA]:
-            dma_src = self.ram[Mem.DMA] << 8
-            for i in range(0, 0xA0):
-                self.ram[Mem.OAM_BASE + i] = self.ram[dma_src + i]
-            self.ram[Mem.DMA] = 0x00
+        # TODO: during the transfer the CPU should only be able to access HRAM
+        src = self.ram.read_range(val << 8, 0xA0)
+        if self.ram.data[Mem.OAM_BASE : Mem.OAM_BASE + 0xA0] != src:
+            self.ram.data[Mem.OAM_BASE : Mem.OAM_BASE + 0xA0] = src
+            self.ram.video_changed = True
+        self.ram.oam_locked = True
+        self._dma_end = self.cycle + 160
+        self.next_event = min(self._timer_event, self._dma_end)
+        return val
 
     def tick_clock(self) -> None:
         """
-        Increment the timer registers, and send an interrupt
-        when `ram[Mem.:TIMA]` wraps around.
+        Called once we've reached the next event - either the end of
+        a DMA transfer, or the predicted TIMA overflow, in which case
+        reload TIMA from TMA, send an interrupt, and predict the next one.
         """
-        self.cycle += 1
+        if self.cycle >= self._dma_end:
+            self.ram.oam_locked = False
+            self._dma_end = sys.maxsize
+            self.next_event = self._timer_event
+        while self.cycle >= self._timer_event:
+            self._tima_base = self.ram[Mem.TMA]
+            self._tima_base_cycle = self._timer_event
+            self.interrupt(Interrupt.TIMER)
+            self._schedule_timer(self.ram[Mem.TAC])
+
+    def _timer_speed(self, tac: int) -> int:
+        """
+        How many cycles per TIMA increment, or 0 if the timer is off
+        """
+        if tac & 1 << 2 == 1 << 2:
+            speeds = [256, 4, 16, 64]  # increment per X cycles
+            return speeds[tac & 0x03]
+        return 0
+
+    def _schedule_timer(self, tac: int) -> None:
+        speed = self._timer_speed(tac)
+        if speed:
+            start = self._tima_base_cycle // speed
+            self._timer_event = (start + 0x100 - self._tima_base) * speed
+        else:
+            self._timer_event = sys.maxsize
+        self.next_event = min(self._timer_event, self._dma_end)
 
-        # TODO: writing any value to Mem.:DIV should reset it to 0x00
+    def _read_div(self) -> int:
         # increment at 16384Hz (each 64 cycles?)
-        if self.cycle % 64 == 0:
-            self.ram[Mem.DIV] = (self.ram[Mem.DIV] + 1) & 0xFF
+        return ((self.cycle - self._div_base) // 64) & 0xFF
+
+    def _write_div(self, val: int) -> int:
+        # writing any value to DIV resets it to 0x00
+        self._div_base = self.cycle
+        return 0
+
+    def _read_tima(self) -> int:
+        if self.cycle >= self.next_event:
+            self.tick_clock()
+        speed = self._timer_speed(self.ram[Mem.TAC])
+        if not speed:
+            return self._tima_base
+        return self._tima_base + self.cycle // speed - self._tima_base_cycle // speed
+
+    def _write_tima(self, val: int) -> int:
+        self._tima_base = val
+        self._tima_base_cycle = self.cycle
+        self._schedule_timer(self.ram[Mem.TAC])
+        return val
+
+    def _write_tac(self, val: int) -> int:
+        # count up to now at the old speed, then switch to the new one
+        self._tima_base = self._read_tima()
+        self._tima_base_cycle = self.cycle
+        self._schedule_timer(val)
+        return val
+
+    def _update_interrupt_pending(self) -> None:
+        data = self.ram.data
+        self.interrupt_pending = self.interrupts and bool(
+            data[Mem.IE] & data[Mem.IF] & 0x1F
+        )
 
-        if self.ram[Mem.TAC] & 1 << 2 == 1 << 2:
-            # timer enable
-            speeds = [256, 4, 16, 64]  # increment per X cycles
-            speed = speeds[self.ram[Mem.TAC] & 0x03]
-            if self.cycle % speed == 0:
-                if self.ram[Mem.TIMA] == 0xFF:
-                    self.ram[Mem.TIMA] = self.ram[
-                        Mem.TMA
-                    ]  # if timer overflows, load base
-                    self.interrupt(Interrupt.TIMER)
-                self.ram[Mem.TIMA] += 1
+    def _write_if(self, val: int) -> int:
+        self.ram.data[Mem.IF] = val
+        self._update_interrupt_pending()
+        return val
+
+    def _write_ie(self, val: int) -> int:
+        self.ram.data[Mem.IE] = val
+        self._update_interrupt_pending()
+        return val
 
     def tick_interrupts(self) -> None:
         """
@@ -195,82 +385,239 @@ class CPU:
 
             # no nested interrupts, RETI will re-enable
             self.interrupts = False
+            self.interrupt_pending = False
+            self._idle_armed = None
 
             # TODO: wait two cycles
             # TODO: push16(PC) should also take two cycles
             # TODO: one more cycle to store new PC
             if queued_interrupts & Interrupt.VBLANK:
-                self._push16(Reg.PC)
+                self._push16(self.PC)
                 self.PC = Mem.VBLANK_HANDLER
                 self.ram[Mem.IF] &= ~Interrupt.VBLANK
             elif queued_interrupts & Interrupt.STAT:
-                self._push16(Reg.PC)
+                self._push16(self.PC)
                 self.PC = Mem.LCD_HANDLER
                 self.ram[Mem.IF] &= ~Interrupt.STAT
             elif queued_interrupts & Interrupt.TIMER:
-                self._push16(Reg.PC)
+                self._push16(self.PC)
                 self.PC = Mem.TIMER_HANDLER
                 self.ram[Mem.IF] &= ~Interrupt.TIMER
             elif queued_interrupts & Interrupt.SERIAL:
-                self._push16(Reg.PC)
+                self._push16(self.PC)
                 self.PC = Mem.SERIAL_HANDLER
                 self.ram[Mem.IF] &= ~Interrupt.SERIAL
             elif queued_interrupts & Interrupt.JOYPAD:
-                self._push16(Reg.PC)
+                self._push16(self.PC)
                 self.PC = Mem.JOYPAD_HANDLER
                 self.ram[Mem.IF] &= ~Interrupt.JOYPAD
 
-    def tick_instructions(self) -> None:
+    def tick_instructions(self) -> int:
+        """
+        Execute the instruction at PC, and return how many machine
+        cycles it took
+        """
         # TODO: extra cycles when conditional jumps are taken
-        if self._owed_cycles:
-            self._owed_cycles -= 4
-            return
-
         src = self.ram
+        pc = self.PC
 
-        original_pc = self.PC
+        if self._debug:
+            print(self.dump(pc, self.disassemble(pc)))
 
-        ins = src[self.PC]
+        ins = src[pc]
         if ins == 0xCB:
-            ins = src[self.PC + 1]
-            cmd = self.cb_ops[ins]
-            self.PC += 1
+            pc += 1
+            cmd, kind, cycles = self.cb_op_table[src[pc]]
         else:
-            cmd = self.ops[ins]
+            cmd, kind, cycles = self.op_table[ins]
 
-        param: Optional[int]
-
-        if cmd.args == "B":
-            param = src[self.PC + 1]
-            cmd_str = cmd.name.replace("n", "$%02X" % param)
-            self.PC += 2
-        elif cmd.args == "b":
-            param = src[self.PC + 1]
+        if kind == ARG_NONE:
+            self.PC = pc + 1
+            cmd()
+        elif kind == ARG_U8:
+            self.PC = pc + 2
+            cmd(src[pc + 1])
+        elif kind == ARG_I8:
+            param = src[pc + 1]
             if param > 128:
                 param -= 256
-                cmd_str = cmd.name.replace("n", "%d" % param)
-            else:
-                cmd_str = cmd.name.replace("n", "+%d" % param)
-            self.PC += 2
-        elif cmd.args == "H":
-            param = (src[self.PC + 1]) | (src[self.PC + 2] << 8)
-            cmd_str = cmd.name.replace("nn", "$%04X" % param)
-            self.PC += 3
+            self.PC = pc + 2
+            cmd(param)
         else:
-            param = None
-            cmd_str = cmd.name
-            self.PC += 1
-        self._debug_str = f"[{self.PC:04X}({ins:02X})]: {cmd_str}"
+            self.PC = pc + 3
+            cmd(src[pc + 1] | src[pc + 2] << 8)
 
-        if self._debug:
-            print(self.dump(original_pc, cmd_str))
+        return cycles >> 2
 
-        if param is not None:
-            cmd(param)
+    def tick_block(self) -> int:
+        """
+        Run the compiled block of instructions starting at PC (compiling
+        it first if we haven't been here before), and return how many
+        machine cycles it took
+        """
+        pc = self.PC
+        if pc < 0x4000:
+            if pc < 0x100 and self.ram.data[Mem.BOOT] == 0:
+                # boot ROM is mapped over the cart, don't cache it
+                return self.tick_instructions()
+            blocks, key = self._rom_blocks, pc
+        elif pc < 0x8000:
+            blocks, key = self._rom_blocks, self.ram.rom_bank << 16 | pc
+        elif 0xC000 <= pc < 0xE000 or 0xFF80 <= pc < 0xFFFF:
+            blocks, key = self._ram_blocks, pc
         else:
-            cmd()
+            return self.tick_instructions()
+
+        block = blocks.get(key)
+        if block is None:
+            block = compile_block(self, pc)
+            blocks[key] = block
+            if blocks is self._ram_blocks:
+                self.ram.watch_code(pc, block.end)
+        # Every instruction in the block has to start before the next
+        # event, as it would if we were stepping through them one by
+        # one - if they won't, step through them one by one
+        last = self.cycle + block.last_start
+        if last >= self._until or last >= self.next_event:
+            return self.tick_instructions()
+        return block()
+
+    def _flush_ram_blocks(self, addr: int) -> None:
+        """
+        Something wrote to RAM that we've compiled code from - throw
+        away the blocks which were compiled from that address, and
+        only those
+        """
+        for start in self.ram.code_at(addr):
+            del self._ram_blocks[start]
+            self.ram.unwatch_code(start)
+        self._code_written = True
+
+    # </editor-fold>
+
+    # <editor-fold description="Idle Loops">
+    def _idle_jump(self, jump):
+        """
+        Wrap a relative jump handler so that taking it backwards checks
+        whether we are in a busy-wait loop
+        """
+
+        def op(n):
+            pc = self.PC
+            jump(n)
+            if self.PC != pc and n < 0:
+                self._idle_loop(pc - 2, self.PC)
+            else:
+                self._idle_armed = None
+
+        op.name = jump.name
+        op.cycles = jump.cycles
+        op.args = jump.args
+        return op
+
+    def _idle_loop(self, jump_pc: int, start: int) -> None:
+        """
+        We just jumped from `jump_pc` back to `start` - if everything
+        in between only polls memory, then nothing will change until the
+        next event (LCD mode change, timer overflow, input poll, etc),
+        so we can skip ahead to just before it.
+        """
+        # Only cache loops in ROM, where the code can't change under us
+        if jump_pc >= 0x8000:
+            return
+        key = (self.ram.rom_bank if jump_pc >= 0x4000 else 0, jump_pc)
+        loop = self._idle_loops.get(key)
+        if loop is None:
+            loop = self._idle_loop_cycles(start, jump_pc)
+            self._idle_loops[key] = loop
+        loop_cycles, polls_lcd = loop
+        if not loop_cycles:
+            return
 
-        self._owed_cycles = cmd.cycles - 4
+        # Only skip once we've been all the way round the loop since
+        # entering it, so that A and the flags are in a steady state
+        if self._idle_armed != jump_pc:
+            self._idle_armed = jump_pc
+            return
+
+        jump_cycles = self.op_table[self.ram[jump_pc]][2] >> 2
+        until = min(self._until, self.next_event)
+        if polls_lcd:
+            # LY and STAT change by themselves, at the start of each
+            # line and each LCD mode within it
+            lx = self.cycle % 114
+            until = min(
+                until, self.cycle - lx + (20 if lx < 20 else 63 if lx < 63 else 114)
+            )
+        loops = (until - (self.cycle + jump_cycles)) // loop_cycles
+        if loops > 0:
+            self.cycle += loops * loop_cycles
+            self.idle_loops_skipped += 1
+            self.idle_cycles_skipped += loops * loop_cycles
+
+    def _idle_loop_cycles(self, start: int, jump_pc: int) -> Tuple[int, bool]:
+        """
+        If the code from `start` up to and including the jump at
+        `jump_pc` is a side-effect-free polling loop, return how many
+        cycles each time round takes (else 0), and whether it reads LY
+        or STAT.
+
+        >>> cpu = CPU()
+
+        Waiting for LY to reach 0x90 with LDH A,[LY] / CP $90 / JR NZ:
+
+        >>> for n, b in enumerate([0xF0, 0x44, 0xFE, 0x90, 0x20, 0xFA]):
+        ...     cpu.ram[0xC000 + n] = b
+        >>> cpu._idle_loop_cycles(0xC000, 0xC004)
+        (7, True)
+
+        The same wait through HL (LD HL,LY / CP [HL] / JR NZ) isn't
+        skippable, since what HL points at can't be checked up front:
+
+        >>> for n, b in enumerate([0x21, 0x44, 0xFF, 0xBE, 0x20, 0xFD]):
+        ...     cpu.ram[0xC000 + n] = b
+        >>> cpu._idle_loop_cycles(0xC003, 0xC004)
+        (0, False)
+
+        Nor is BIT b,[HL] (LD HL,STAT / BIT 1,[HL] / JR Z):
+
+        >>> for n, b in enumerate([0x21, 0x41, 0xFF, 0xCB, 0x4E, 0x28, 0xFC]):
+        ...     cpu.ram[0xC000 + n] = b
+        >>> cpu._idle_loop_cycles(0xC003, 0xC005)
+        (0, False)
+        """
+        src = self.ram
+        pc = start
+        cycles = 0
+        polls_lcd = False
+        while pc < jump_pc:
+            ins = src[pc]
+            if ins == 0xCB:
+                if src[pc + 1] not in IDLE_SAFE_CB_OPS:
+                    return 0, False
+                cycles += self.cb_op_table[src[pc + 1]][2]
+                pc += 2
+                continue
+            if ins not in IDLE_SAFE_OPS:
+                return 0, False
+            _, kind, ins_cycles = self.op_table[ins]
+            if ins == 0xF0:
+                addr = 0xFF00 + src[pc + 1]
+            elif ins == 0xFA:
+                addr = src[pc + 1] | src[pc + 2] << 8
+            else:
+                addr = None
+            # the timer registers change by themselves, so they are
+            # never idle, and external RAM might not be readable
+            if addr in (Mem.DIV, Mem.TIMA) or (addr and 0xA000 <= addr < 0xC000):
+                return 0, False
+            if addr in (Mem.LY, Mem.STAT):
+                polls_lcd = True
+            cycles += ins_cycles
+            pc += (1, 2, 2, 3)[kind]
+        if pc != jump_pc:
+            return 0, False
+        return (cycles + self.op_table[src[jump_pc]][2]) >> 2, polls_lcd
 
     # </editor-fold>
 
@@ -360,13 +707,21 @@ class CPU:
         self.H = val >> 8 & 0xFF
         self.L = val & 0xFF
 
-    @property
-    def MEM_AT_HL(self) -> int:
-        return self.ram[self.HL]
+    def snapshot(self) -> Tuple:
+        """
+        All of the registers and flags, in REGISTERS order, in one go
+
+        >>> cpu = CPU()
+        >>> cpu.BC = 0x1234
+        >>> cpu.snapshot()[1:3]
+        (18, 52)
+        """
+        return _read_registers(self)
 
-    @MEM_AT_HL.setter
-    def MEM_AT_HL(self, val: int) -> None:
-        self.ram[self.HL] = val
+    def restore(self, regs: Tuple) -> None:
+        """Put back registers and flags from snapshot()"""
+        for name, val in zip(REGISTERS, regs):
+            setattr(self, name, val)
 
     # </editor-fold>
 
@@ -406,16 +761,11 @@ class CPU:
     for base, reg_to in enumerate(GEN_REGS):
         cycles = 12 if "[HL]" in {reg_to} else 8
         op = 0x06 + base * 8
-        reg_to_name = reg_to.replace("[HL]", "MEM_AT_HL")
-        exec(
-            dedent(
-                f"""
+        exec(dedent(f"""
             @opcode("LD {reg_to},n", {cycles}, "B")
             def op{op:02X}(self, val):
-                self.{reg_to_name} = val
-        """
-            )
-        )
+                {_reg(reg_to)} = val
+        """))
 
     # ===================================
     # 2. LD r1,r2
@@ -427,17 +777,11 @@ class CPU:
 
             cycles = 8 if "[HL]" in {reg_from, reg_to} else 4
             op = 0x40 + base * 8 + offset
-            reg_to_name = reg_to.replace("[HL]", "MEM_AT_HL")
-            reg_from_name = reg_from.replace("[HL]", "MEM_AT_HL")
-            exec(
-                dedent(
-                    f"""
+            exec(dedent(f"""
                 @opcode("LD {reg_to},{reg_from}", {cycles})
                 def op{op:02X}(self):
-                    self.{reg_to_name} = self.{reg_from_name}
-            """
-                )
-            )
+                    {_reg(reg_to)} = {_reg(reg_from)}
+            """))
 
     # ===================================
     # 3. LD A,n
@@ -445,8 +789,12 @@ class CPU:
     def _ld_val_to_a(self, val):
         self.A = val
 
-    op0A = opcode("LD A,[BC]", 8)(lambda self: self._ld_val_to_a(self.ram[self.BC]))
-    op1A = opcode("LD A,[DE]", 8)(lambda self: self._ld_val_to_a(self.ram[self.DE]))
+    op0A = opcode("LD A,[BC]", 8)(
+        lambda self: self._ld_val_to_a(self.ram[self.B << 8 | self.C])
+    )
+    op1A = opcode("LD A,[DE]", 8)(
+        lambda self: self._ld_val_to_a(self.ram[self.D << 8 | self.E])
+    )
     opFA = opcode("LD A,[nn]", 16, "H")(
         lambda self, val: self._ld_val_to_a(self.ram[val])
     )
@@ -456,8 +804,8 @@ class CPU:
     def _ld_a_to_mem(self, val):
         self.ram[val] = self.A
 
-    op02 = opcode("LD [BC],A", 8)(lambda self: self._ld_a_to_mem(self.BC))
-    op12 = opcode("LD [DE],A", 8)(lambda self: self._ld_a_to_mem(self.DE))
+    op02 = opcode("LD [BC],A", 8)(lambda self: self._ld_a_to_mem(self.B << 8 | self.C))
+    op12 = opcode("LD [DE],A", 8)(lambda self: self._ld_a_to_mem(self.D << 8 | self.E))
     opEA = opcode("LD [nn],A", 16, "H")(lambda self, val: self._ld_a_to_mem(val))
 
     # ===================================
@@ -478,8 +826,11 @@ class CPU:
     # 9. LDD A,[HL]
     @opcode("LD A,[HL-]", 8)
     def op3A(self):
-        self.A = self.ram[self.HL]
-        self.HL -= 1
+        hl = self.H << 8 | self.L
+        self.A = self.ram[hl]
+        hl = (hl - 1) & 0xFFFF
+        self.H = hl >> 8
+        self.L = hl & 0xFF
 
     # ===================================
     # 10. LD [HLD],A
@@ -487,8 +838,11 @@ class CPU:
     # 12. LDD [HL],A
     @opcode("LD [HL-],A", 8)
     def op32(self):
-        self.ram[self.HL] = self.A
-        self.HL -= 1
+        hl = self.H << 8 | self.L
+        self.ram[hl] = self.A
+        hl = (hl - 1) & 0xFFFF
+        self.H = hl >> 8
+        self.L = hl & 0xFF
 
     # ===================================
     # 13. LD A,[HLI]
@@ -496,8 +850,11 @@ class CPU:
     # 15. LDI A,[HL]
     @opcode("LD A,[HL+]", 8)
     def op2A(self):
-        self.A = self.ram[self.HL]
-        self.HL += 1
+        hl = self.H << 8 | self.L
+        self.A = self.ram[hl]
+        hl = (hl + 1) & 0xFFFF
+        self.H = hl >> 8
+        self.L = hl & 0xFF
 
     # ===================================
     # 16. LD [HLI],A
@@ -505,8 +862,11 @@ class CPU:
     # 18. LDI [HL],A
     @opcode("LD [HL+],A", 8)
     def op22(self):
-        self.ram[self.HL] = self.A
-        self.HL += 1
+        hl = self.H << 8 | self.L
+        self.ram[hl] = self.A
+        hl = (hl + 1) & 0xFFFF
+        self.H = hl >> 8
+        self.L = hl & 0xFF
 
     # ===================================
     # 19. LDH [n],A
@@ -529,28 +889,24 @@ class CPU:
     # <editor-fold description="3.3.2 16-Bit Loads">
     # ===================================
     # 1. LD n,nn
-    def _ld_val_to_reg(self, val, reg: Reg):
-        setattr(self, reg.value, val)
+    for op, hi, lo in [(0x01, "B", "C"), (0x11, "D", "E"), (0x21, "H", "L")]:
+        exec(dedent(f"""
+            @opcode("LD {hi}{lo},nn", 12, "H")
+            def op{op:02X}(self, val):
+                self.{hi} = val >> 8
+                self.{lo} = val & 0xFF
+        """))
 
-    op01 = opcode("LD BC,nn", 12, "H")(
-        lambda self, val: self._ld_val_to_reg(val, Reg.BC)
-    )
-    op11 = opcode("LD DE,nn", 12, "H")(
-        lambda self, val: self._ld_val_to_reg(val, Reg.DE)
-    )
-    op21 = opcode("LD HL,nn", 12, "H")(
-        lambda self, val: self._ld_val_to_reg(val, Reg.HL)
-    )
-    op31 = opcode("LD SP,nn", 12, "H")(
-        lambda self, val: self._ld_val_to_reg(val, Reg.SP)
-    )
+    @opcode("LD SP,nn", 12, "H")
+    def op31(self, val):
+        self.SP = val
 
     # ===================================
     # 2. LD SP,HL
 
     @opcode("LD SP,HL", 8)
     def opF9(self):
-        self.SP = self.HL
+        self.SP = self.H << 8 | self.L
 
     # ===================================
     # 3. LD HL,SP+n
@@ -563,7 +919,9 @@ class CPU:
         else:
             self.FLAG_C = ((self.SP + val) & 0xFF) <= (self.SP & 0xFF)
             self.FLAG_H = ((self.SP + val) & 0x0F) <= (self.SP & 0x0F)
-        self.HL = self.SP + val
+        hl = (self.SP + val) & 0xFFFF
+        self.H = hl >> 8
+        self.L = hl & 0xFF
         self.FLAG_Z = False
         self.FLAG_N = False
 
@@ -576,7 +934,7 @@ class CPU:
 
     # ===================================
     # 6. PUSH nn
-    def _push16(self, reg: Reg):
+    def _push16(self, val: int):
         """
         >>> c = CPU()
         >>> c.BC = 1234
@@ -585,29 +943,50 @@ class CPU:
         >>> c.DE
         1234
         """
-        val = getattr(self, reg.value)
         self.ram[self.SP - 1] = (val & 0xFF00) >> 8
         self.ram[self.SP - 2] = val & 0xFF
         self.SP -= 2
         # print("Pushing %r to stack at %r [%r]" % (val, self.SP, self.ram[-10:]))
 
-    opF5 = opcode("PUSH AF", 16)(lambda self: self._push16(Reg.AF))
-    opC5 = opcode("PUSH BC", 16)(lambda self: self._push16(Reg.BC))
-    opD5 = opcode("PUSH DE", 16)(lambda self: self._push16(Reg.DE))
-    opE5 = opcode("PUSH HL", 16)(lambda self: self._push16(Reg.HL))
+    opC5 = opcode("PUSH BC", 16)(lambda self: self._push16(self.B << 8 | self.C))
+    opD5 = opcode("PUSH DE", 16)(lambda self: self._push16(self.D << 8 | self.E))
+    opE5 = opcode("PUSH HL", 16)(lambda self: self._push16(self.H << 8 | self.L))
+
+    @opcode("PUSH AF", 16)
+    def opF5(self):
+        self._push16(
+            self.A << 8
+            | (self.FLAG_Z or 0) << 7
+            | (self.FLAG_N or 0) << 6
+            | (self.FLAG_H or 0) << 5
+            | (self.FLAG_C or 0) << 4
+        )
 
     # ===================================
     # 6. POP nn
-    def _pop16(self, reg: Reg):
+    def _pop16(self) -> int:
         val = (self.ram[self.SP + 1] << 8) | self.ram[self.SP]
-        # print("Set %r to %r from %r, %r" % (reg, val, self.SP, self.ram[-10:]))
-        setattr(self, reg.value, val)
         self.SP += 2
-
-    opF1 = opcode("POP AF", 12)(lambda self: self._pop16(Reg.AF))
-    opC1 = opcode("POP BC", 12)(lambda self: self._pop16(Reg.BC))
-    opD1 = opcode("POP DE", 12)(lambda self: self._pop16(Reg.DE))
-    opE1 = opcode("POP HL", 12)(lambda self: self._pop16(Reg.HL))
+        return val
+
+    for op, hi, lo in [(0xC1, "B", "C"), (0xD1, "D", "E"), (0xE1, "H", "L")]:
+        exec(dedent(f"""
+            @opcode("POP {hi}{lo}", 12)
+            def op{op:02X}(self):
+                self.{lo} = self.ram[self.SP]
+                self.{hi} = self.ram[self.SP + 1]
+                self.SP += 2
+        """))
+
+    @opcode("POP AF", 12)
+    def opF1(self):
+        val = self.ram[self.SP]
+        self.A = self.ram[self.SP + 1]
+        self.FLAG_Z = bool(val & 0b10000000)
+        self.FLAG_N = bool(val & 0b01000000)
+        self.FLAG_H = bool(val & 0b00100000)
+        self.FLAG_C = bool(val & 0b00010000)
+        self.SP += 2
 
     # </editor-fold>
 
@@ -629,7 +1008,9 @@ class CPU:
     op83 = opcode("ADD A,E", 4)(lambda self: self._add(self.E))
     op84 = opcode("ADD A,H", 4)(lambda self: self._add(self.H))
     op85 = opcode("ADD A,L", 4)(lambda self: self._add(self.L))
-    op86 = opcode("ADD A,[HL]", 8)(lambda self: self._add(self.MEM_AT_HL))
+    op86 = opcode("ADD A,[HL]", 8)(
+        lambda self: self._add(self.ram[self.H << 8 | self.L])
+    )
     op87 = opcode("ADD A,A", 4)(lambda self: self._add(self.A))
 
     opC6 = opcode("ADD A,n", 8, "B")(lambda self, val: self._add(val))
@@ -660,7 +1041,9 @@ class CPU:
     op8B = opcode("ADC A,E", 4)(lambda self: self._adc(self.E))
     op8C = opcode("ADC A,H", 4)(lambda self: self._adc(self.H))
     op8D = opcode("ADC A,L", 4)(lambda self: self._adc(self.L))
-    op8E = opcode("ADC A,[HL]", 8)(lambda self: self._adc(self.MEM_AT_HL))
+    op8E = opcode("ADC A,[HL]", 8)(
+        lambda self: self._adc(self.ram[self.H << 8 | self.L])
+    )
     op8F = opcode("ADC A,A", 4)(lambda self: self._adc(self.A))
 
     opCE = opcode("ADC A,n", 8, "B")(lambda self, val: self._adc(val))
@@ -681,7 +1064,9 @@ class CPU:
     op93 = opcode("SUB A,E", 4)(lambda self: self._sub(self.E))
     op94 = opcode("SUB A,H", 4)(lambda self: self._sub(self.H))
     op95 = opcode("SUB A,L", 4)(lambda self: self._sub(self.L))
-    op96 = opcode("SUB A,[HL]", 8)(lambda self: self._sub(self.MEM_AT_HL))
+    op96 = opcode("SUB A,[HL]", 8)(
+        lambda self: self._sub(self.ram[self.H << 8 | self.L])
+    )
     op97 = opcode("SUB A,A", 4)(lambda self: self._sub(self.A))
 
     opD6 = opcode("SUB A,n", 8, "B")(lambda self, val: self._sub(val))
@@ -710,7 +1095,9 @@ class CPU:
     op9B = opcode("SBC A,E", 4)(lambda self: self._sbc(self.E))
     op9C = opcode("SBC A,H", 4)(lambda self: self._sbc(self.H))
     op9D = opcode("SBC A,L", 4)(lambda self: self._sbc(self.L))
-    op9E = opcode("SBC A,[HL]", 8)(lambda self: self._sbc(self.MEM_AT_HL))
+    op9E = opcode("SBC A,[HL]", 8)(
+        lambda self: self._sbc(self.ram[self.H << 8 | self.L])
+    )
     op9F = opcode("SBC A,A", 4)(lambda self: self._sbc(self.A))
 
     opDE = opcode("SBC A,n", 8, "B")(lambda self, val: self._sbc(val))
@@ -738,7 +1125,7 @@ class CPU:
     opA3 = opcode("AND E", 4)(lambda self: self._and(self.E))
     opA4 = opcode("AND H", 4)(lambda self: self._and(self.H))
     opA5 = opcode("AND L", 4)(lambda self: self._and(self.L))
-    opA6 = opcode("AND [HL]", 8)(lambda self: self._and(self.MEM_AT_HL))
+    opA6 = opcode("AND [HL]", 8)(lambda self: self._and(self.ram[self.H << 8 | self.L]))
     opA7 = opcode("AND A", 4)(lambda self: self._and(self.A))
 
     opE6 = opcode("AND n", 8, "B")(lambda self, n: self._and(n))
@@ -766,7 +1153,7 @@ class CPU:
     opB3 = opcode("OR E", 4)(lambda self: self._or(self.E))
     opB4 = opcode("OR H", 4)(lambda self: self._or(self.H))
     opB5 = opcode("OR L", 4)(lambda self: self._or(self.L))
-    opB6 = opcode("OR [HL]", 8)(lambda self: self._or(self.MEM_AT_HL))
+    opB6 = opcode("OR [HL]", 8)(lambda self: self._or(self.ram[self.H << 8 | self.L]))
     opB7 = opcode("OR A", 4)(lambda self: self._or(self.A))
 
     opF6 = opcode("OR n", 8, "B")(lambda self, n: self._or(n))
@@ -794,7 +1181,7 @@ class CPU:
     opAB = opcode("XOR E", 4)(lambda self: self._xor(self.E))
     opAC = opcode("XOR H", 4)(lambda self: self._xor(self.H))
     opAD = opcode("XOR L", 4)(lambda self: self._xor(self.L))
-    opAE = opcode("XOR [HL]", 8)(lambda self: self._xor(self.MEM_AT_HL))
+    opAE = opcode("XOR [HL]", 8)(lambda self: self._xor(self.ram[self.H << 8 | self.L]))
     opAF = opcode("XOR A", 4)(lambda self: self._xor(self.A))
 
     opEE = opcode("XOR n", 8, "B")(lambda self, n: self._xor(n))
@@ -814,48 +1201,42 @@ class CPU:
     opBB = opcode("CP E", 4)(lambda self: self._cp(self.E))
     opBC = opcode("CP H", 4)(lambda self: self._cp(self.H))
     opBD = opcode("CP L", 4)(lambda self: self._cp(self.L))
-    opBE = opcode("CP [HL]", 8)(lambda self: self._cp(self.MEM_AT_HL))
+    opBE = opcode("CP [HL]", 8)(lambda self: self._cp(self.ram[self.H << 8 | self.L]))
     opBF = opcode("CP A", 4)(lambda self: self._cp(self.A))
 
     opFE = opcode("CP n", 8, "B")(lambda self, val: self._cp(val))
 
     # ===================================
     # 9. INC
-    def _inc8(self, reg: Reg):
-        val = getattr(self, reg.value)
+    def _inc8(self, val: int) -> int:
         self.FLAG_H = val & 0x0F == 0x0F
         val = (val + 1) & 0xFF
-        setattr(self, reg.value, val)
         self.FLAG_Z = val == 0
         self.FLAG_N = False
+        return val
 
-    op04 = opcode("INC B", 4)(lambda self: self._inc8(Reg.B))
-    op0C = opcode("INC C", 4)(lambda self: self._inc8(Reg.C))
-    op14 = opcode("INC D", 4)(lambda self: self._inc8(Reg.D))
-    op1C = opcode("INC E", 4)(lambda self: self._inc8(Reg.E))
-    op24 = opcode("INC H", 4)(lambda self: self._inc8(Reg.H))
-    op2C = opcode("INC L", 4)(lambda self: self._inc8(Reg.L))
-    op34 = opcode("INC [HL]", 12)(lambda self: self._inc8(Reg.MEM_AT_HL))
-    op3C = opcode("INC A", 4)(lambda self: self._inc8(Reg.A))
+    for base, reg in enumerate(GEN_REGS):
+        exec(dedent(f"""
+            @opcode("INC {reg}", {12 if reg == "[HL]" else 4})
+            def op{0x04 + base * 8:02X}(self):
+                {_reg(reg)} = self._inc8({_reg(reg)})
+        """))
 
     # ===================================
     # 10. DEC
-    def _dec8(self, reg: Reg):
-        val = getattr(self, reg.value)
+    def _dec8(self, val: int) -> int:
         val = (val - 1) & 0xFF
         self.FLAG_H = val & 0x0F == 0x0F
-        setattr(self, reg.value, val)
         self.FLAG_Z = val == 0
         self.FLAG_N = True
-
-    op05 = opcode("DEC B", 4)(lambda self: self._dec8(Reg.B))
-    op0D = opcode("DEC C", 4)(lambda self: self._dec8(Reg.C))
-    op15 = opcode("DEC D", 4)(lambda self: self._dec8(Reg.D))
-    op1D = opcode("DEC E", 4)(lambda self: self._dec8(Reg.E))
-    op25 = opcode("DEC H", 4)(lambda self: self._dec8(Reg.H))
-    op2D = opcode("DEC L", 4)(lambda self: self._dec8(Reg.L))
-    op35 = opcode("DEC [HL]", 12)(lambda self: self._dec8(Reg.MEM_AT_HL))
-    op3D = opcode("DEC A", 4)(lambda self: self._dec8(Reg.A))
+        return val
+
+    for base, reg in enumerate(GEN_REGS):
+        exec(dedent(f"""
+            @opcode("DEC {reg}", {12 if reg == "[HL]" else 4})
+            def op{0x05 + base * 8:02X}(self):
+                {_reg(reg)} = self._dec8({_reg(reg)})
+        """))
     # </editor-fold>
 
     # <editor-fold description="3.3.4 16-Bit Arithmetic">
@@ -863,15 +1244,17 @@ class CPU:
     # ===================================
     # 1. ADD HL,nn
     def _add_hl(self, val):
-        self.FLAG_H = (self.HL & 0x0FFF) + (val & 0x0FFF) > 0x0FFF
-        self.FLAG_C = self.HL + val > 0xFFFF
-        self.HL += val
-        self.HL &= 0xFFFF
+        hl = self.H << 8 | self.L
+        self.FLAG_H = (hl & 0x0FFF) + (val & 0x0FFF) > 0x0FFF
+        self.FLAG_C = hl + val > 0xFFFF
+        hl = (hl + val) & 0xFFFF
+        self.H = hl >> 8
+        self.L = hl & 0xFF
         self.FLAG_N = False
 
-    op09 = opcode("ADD HL,BC", 8)(lambda self: self._add_hl(self.BC))
-    op19 = opcode("ADD HL,DE", 8)(lambda self: self._add_hl(self.DE))
-    op29 = opcode("ADD HL,HL", 8)(lambda self: self._add_hl(self.HL))
+    op09 = opcode("ADD HL,BC", 8)(lambda self: self._add_hl(self.B << 8 | self.C))
+    op19 = opcode("ADD HL,DE", 8)(lambda self: self._add_hl(self.D << 8 | self.E))
+    op29 = opcode("ADD HL,HL", 8)(lambda self: self._add_hl(self.H << 8 | self.L))
     op39 = opcode("ADD HL,SP", 8)(lambda self: self._add_hl(self.SP))
 
     # ===================================
@@ -888,27 +1271,24 @@ class CPU:
 
     # ===================================
     # 3. INC nn
-    def _inc16(self, reg):
-        val = getattr(self, reg)
-        val = (val + 1) & 0xFFFF
-        setattr(self, reg, val)
-
-    op03 = opcode("INC BC", 8)(lambda self: self._inc16("BC"))
-    op13 = opcode("INC DE", 8)(lambda self: self._inc16("DE"))
-    op23 = opcode("INC HL", 8)(lambda self: self._inc16("HL"))
-    op33 = opcode("INC SP", 8)(lambda self: self._inc16("SP"))
-
-    # ===================================
     # 4. DEC nn
-    def _dec16(self, reg):
-        val = getattr(self, reg)
-        val = (val - 1) & 0xFFFF
-        setattr(self, reg, val)
-
-    op0B = opcode("DEC BC", 8)(lambda self: self._dec16("BC"))
-    op1B = opcode("DEC DE", 8)(lambda self: self._dec16("DE"))
-    op2B = opcode("DEC HL", 8)(lambda self: self._dec16("HL"))
-    op3B = opcode("DEC SP", 8)(lambda self: self._dec16("SP"))
+    for op, hi, lo in [(0x00, "B", "C"), (0x10, "D", "E"), (0x20, "H", "L")]:
+        for ins, mnemonic, sign in [(0x03, "INC", "+"), (0x0B, "DEC", "-")]:
+            exec(dedent(f"""
+                @opcode("{mnemonic} {hi}{lo}", 8)
+                def op{op + ins:02X}(self):
+                    val = ((self.{hi} << 8 | self.{lo}) {sign} 1) & 0xFFFF
+                    self.{hi} = val >> 8
+                    self.{lo} = val & 0xFF
+            """))
+
+    @opcode("INC SP", 8)
+    def op33(self):
+        self.SP = (self.SP + 1) & 0xFFFF
+
+    @opcode("DEC SP", 8)
+    def op3B(self):
+        self.SP = (self.SP - 1) & 0xFFFF
 
     # </editor-fold>
 
@@ -916,14 +1296,13 @@ class CPU:
     # ===================================
     # 1. SWAP
     # FIXME: CB36 takes 16 cycles, not 8
-    def _swap(self, reg: Reg):
-        val = getattr(self, reg.value)
+    def _swap(self, val: int) -> int:
         val = ((val & 0xF0) >> 4) | ((val & 0x0F) << 4)
-        setattr(self, reg.value, val)
         self.FLAG_Z = val == 0
         self.FLAG_N = False
         self.FLAG_H = False
         self.FLAG_C = False
+        return val
 
     # ===================================
     # 2. DAA
@@ -932,10 +1311,10 @@ class CPU:
     def op27(self):
         """
         >>> c = CPU()
-        >>> c.A = 92
+        >>> c.A = 0x5C
         >>> c.op27()
-        >>> bin(c.A)
-        '0b11000010'
+        >>> hex(c.A)
+        '0x62'
         """
         tmp = self.A
 
@@ -1042,6 +1421,7 @@ class CPU:
     def opF3(self):
         # FIXME: supposed to take effect after the following instruction
         self.interrupts = False
+        self.interrupt_pending = False
 
     # ===================================
     # 10. EI
@@ -1049,6 +1429,7 @@ class CPU:
     def opFB(self):
         # FIXME: supposed to take effect after the following instruction
         self.interrupts = True
+        self._update_interrupt_pending()
 
     # </editor-fold>
 
@@ -1057,16 +1438,11 @@ class CPU:
         for offset, reg in enumerate(GEN_REGS):
             op = (base * 8) + offset
             time = 16 if reg == "[HL]" else 8
-            regn = reg.replace("[HL]", "MEM_AT_HL")
-            exec(
-                dedent(
-                    f"""
+            exec(dedent(f"""
                 @opcode("{ins} {reg}", {time})
                 def opCB{op:02X}(self):
-                    self._{ins.lower()}(Reg.{regn})
-            """
-                )
-            )
+                    {_reg(reg)} = self._{ins.lower()}({_reg(reg)})
+            """))
 
     # ===================================
     # 1. RCLA
@@ -1078,7 +1454,7 @@ class CPU:
         >>> c.FLAG_C = False
         >>> c.op07()
         >>> bin(c.A), c.FLAG_C
-        ('0b1010100', True)
+        ('0b1010101', True)
         """
         self.FLAG_C = (self.A & 0b10000000) != 0
         self.A = ((self.A << 1) | (self.A >> 7)) & 0xFF
@@ -1144,110 +1520,103 @@ class CPU:
 
     # ===================================
     # 5. RLC
-    def _rlc(self, reg: Reg):
-        val = getattr(self, reg.value)
+    def _rlc(self, val: int) -> int:
         self.FLAG_C = bool(val & 0b10000000)
         val <<= 1
         if self.FLAG_C:
             val |= 1
         val &= 0xFF
-        setattr(self, reg.value, val)
         self.FLAG_N = False
         self.FLAG_H = False
         self.FLAG_Z = val == 0
+        return val
 
     # ===================================
     # 6. RL
-    def _rl(self, reg: Reg):
+    def _rl(self, val: int) -> int:
         """
         >>> c = CPU()
         >>> c.A = 0xAA
         >>> c.FLAG_C = True
 
-        >>> c._rl(Reg.A)
+        >>> c.A = c._rl(c.A)
         >>> hex(c.A), c.FLAG_C
         ('0x55', True)
-        >>> c._rl(Reg.A)
+        >>> c.A = c._rl(c.A)
         >>> hex(c.A), c.FLAG_C
         ('0xab', False)
-        >>> c._rl(Reg.A)
+        >>> c.A = c._rl(c.A)
         >>> hex(c.A), c.FLAG_C
         ('0x56', True)
-        >>> c._rl(Reg.A)
+        >>> c.A = c._rl(c.A)
         >>> hex(c.A), c.FLAG_C
         ('0xad', False)
         """
         orig_c = self.FLAG_C
-        val = getattr(self, reg.value)
         self.FLAG_C = bool(val & 0b10000000)
         val = ((val << 1) | orig_c) & 0xFF
-        setattr(self, reg.value, val)
         self.FLAG_N = False
         self.FLAG_H = False
         self.FLAG_Z = val == 0
+        return val
 
     # ===================================
     # 7. RRC
-    def _rrc(self, reg: Reg):
-        val = getattr(self, reg.value)
+    def _rrc(self, val: int) -> int:
         self.FLAG_C = bool(val & 0x1)
         val >>= 1
         if self.FLAG_C:
             val |= 0b10000000
-        setattr(self, reg.value, val)
         self.FLAG_N = False
         self.FLAG_H = False
         self.FLAG_Z = val == 0
+        return val
 
     # ===================================
     # 8. RR
-    def _rr(self, reg: Reg):
+    def _rr(self, val: int) -> int:
         orig_c = self.FLAG_C
-        val = getattr(self, reg.value)
         self.FLAG_C = bool(val & 0x1)
         val >>= 1
         if orig_c:
             val |= 1 << 7
-        setattr(self, reg.value, val)
         self.FLAG_N = False
         self.FLAG_H = False
         self.FLAG_Z = val == 0
+        return val
 
     # ===================================
     # 9. SLA
-    def _sla(self, reg: Reg):
-        val = getattr(self, reg.value)
+    def _sla(self, val: int) -> int:
         self.FLAG_C = bool(val & 0b10000000)
         val <<= 1
         val &= 0xFF
-        setattr(self, reg.value, val)
         self.FLAG_N = False
         self.FLAG_H = False
         self.FLAG_Z = val == 0
+        return val
 
     # ===================================
     # 10. SRA
-    def _sra(self, reg: Reg):
-        val = getattr(self, reg.value)
+    def _sra(self, val: int) -> int:
         self.FLAG_C = bool(val & 0x1)
         val >>= 1
         if val & 0b01000000:
             val |= 0b10000000
-        setattr(self, reg.value, val)
         self.FLAG_N = False
         self.FLAG_H = False
         self.FLAG_Z = val == 0
+        return val
 
     # ===================================
     # 11. SRL
-    def _srl(self, reg: Reg):
-        val = getattr(self, reg.value)
+    def _srl(self, val: int) -> int:
         self.FLAG_C = bool(val & 0x1)
         val >>= 1
-        setattr(self, reg.value, val)
         self.FLAG_N = False
         self.FLAG_H = False
         self.FLAG_Z = val == 0
+        return val
 
     # </editor-fold>
 
@@ -1256,39 +1625,36 @@ class CPU:
     # 1. BIT b,r
     def _test_bit(self):
         """
+        Z is set when the bit is clear
+
         >>> c = CPU()
         >>> c.B = 0xFF
         >>> c.opCB40()  # BIT 0,B
         >>> c.FLAG_Z
-        True
+        False
         >>> c.opCB78()  # BIT 7,B
         >>> c.FLAG_Z
-        True
+        False
         >>> c.B = 0x00
         >>> c.opCB40()
         >>> c.FLAG_Z
-        False
+        True
         >>> c.opCB78()
         >>> c.FLAG_Z
-        False
+        True
         """
 
     for b in range(8):
         for offset, reg in enumerate(GEN_REGS):
             op = 0x40 + b * 0x08 + offset
             time = 16 if reg == "[HL]" else 8
-            arg = reg.replace("[HL]", "MEM_AT_HL")
-            exec(
-                dedent(
-                    f"""
+            exec(dedent(f"""
                 @opcode("BIT {b},{reg}", {time})
                 def opCB{op:02X}(self):
-                    self.FLAG_Z = not bool(self.{arg} & (1 << {b}))
+                    self.FLAG_Z = not bool({_reg(reg)} & (1 << {b}))
                     self.FLAG_N = False
                     self.FLAG_H = True
-            """
-                )
-            )
+            """))
 
     # ===================================
     # 3. RES b,r
@@ -1296,16 +1662,11 @@ class CPU:
         for offset, arg in enumerate(GEN_REGS):
             op = 0x80 + b * 0x08 + offset
             time = 16 if arg == "[HL]" else 8
-            arg = arg.replace("[HL]", "MEM_AT_HL")
-            exec(
-                dedent(
-                    f"""
+            exec(dedent(f"""
                 @opcode("RES {b},{arg}", {time})
                 def opCB{op:02X}(self):
-                    self.{arg} &= ((0x01 << {b}) ^ 0xFF)
-            """
-                )
-            )
+                    {_reg(arg)} &= ((0x01 << {b}) ^ 0xFF)
+            """))
 
     # ===================================
     # 2. SET b,r
@@ -1313,16 +1674,11 @@ class CPU:
         for offset, arg in enumerate(GEN_REGS):
             op = 0xC0 + b * 0x08 + offset
             time = 16 if arg == "[HL]" else 8
-            arg = arg.replace("[HL]", "MEM_AT_HL")
-            exec(
-                dedent(
-                    f"""
+            exec(dedent(f"""
                 @opcode("SET {b},{arg}", {time})
                 def opCB{op:02X}(self):
-                    self.{arg} |= (0x01 << {b})
-            """
-                )
-            )
+                    {_reg(arg)} |= (0x01 << {b})
+            """))
 
     # </editor-fold>
 
@@ -1361,7 +1717,7 @@ class CPU:
     @opcode("JP HL", 4)
     def opE9(self):
         # ERROR: docs say this is [HL], not HL...
-        self.PC = self.HL
+        self.PC = self.H << 8 | self.L
 
     # ===================================
     # 4. JR n
@@ -1399,7 +1755,7 @@ class CPU:
     # 1. CALL nn
     @opcode("CALL nn", 24, "H")  # doc says 12
     def opCD(self, nn):
-        self._push16(Reg.PC)
+        self._push16(self.PC)
         self.PC = nn
 
     # ===================================
@@ -1408,25 +1764,25 @@ class CPU:
     @opcode("CALL NZ,nn", 12, "H")
     def opC4(self, n):
         if not self.FLAG_Z:
-            self._push16(Reg.PC)
+            self._push16(self.PC)
             self.PC = n
 
     @opcode("CALL Z,nn", 12, "H")
     def opCC(self, n):
         if self.FLAG_Z:
-            self._push16(Reg.PC)
+            self._push16(self.PC)
             self.PC = n
 
     @opcode("CALL NC,nn", 12, "H")
     def opD4(self, n):
         if not self.FLAG_C:
-            self._push16(Reg.PC)
+            self._push16(self.PC)
             self.PC = n
 
     @opcode("CALL C,nn", 12, "H")
     def opDC(self, n):
         if self.FLAG_C:
-            self._push16(Reg.PC)
+            self._push16(self.PC)
             self.PC = n
 
     # </editor-fold>
@@ -1438,7 +1794,7 @@ class CPU:
     # Jump to address $0000 + n.
     # n = $00,$08,$10,$18,$20,$28,$30,$38
     def _rst(self, val):
-        self._push16(Reg.PC)
+        self._push16(self.PC)
         self.PC = val
 
     # doc says 32 cycles, test says 16
@@ -1458,35 +1814,36 @@ class CPU:
     # 1. RET
     @opcode("RET", 16)  # doc says 8
     def opC9(self):
-        self._pop16(Reg.PC)
+        self.PC = self._pop16()
 
     # ===================================
     # 2. RET cc
     @opcode("RET NZ", 8)
     def opC0(self):
         if not self.FLAG_Z:
-            self._pop16(Reg.PC)
+            self.PC = self._pop16()
 
     @opcode("RET Z", 8)
     def opC8(self):
         if self.FLAG_Z:
-            self._pop16(Reg.PC)
+            self.PC = self._pop16()
 
     @opcode("RET NC", 8)
     def opD0(self):
         if not self.FLAG_C:
-            self._pop16(Reg.PC)
+            self.PC = self._pop16()
 
     @opcode("RET C", 8)
     def opD8(self):
         if self.FLAG_C:
-            self._pop16(Reg.PC)
+            self.PC = self._pop16()
 
     # ===================================
     # 3. RETI
     @opcode("RETI", 16)  # doc says 8
     def opD9(self):
-        self._pop16(Reg.PC)
+        self.PC = self._pop16()
         self.interrupts = True
+        self._update_interrupt_pending()
 
     # </editor-fold>
@@ -113,3 +113,11 @@ class HeaderChecksumFailed(UserException):
 
     def __str__(self) -> str:
         return f"Header checksum failed: {self.header_checksum} != 0"
+
+
+class NumpyMissing(UserException):
+    def __init__(self, err):
+        self.err = err
+
+    def __str__(self) -> str:
+        return f"--numpy needs NumPy to be installed: {self.err}"
@@ -1,26 +1,87 @@
+from sdl2 import SDL_GetError
 from .cart import Cart
 from .cpu import CPU
 from .gpu import GPU
 from .clock import Clock
 from .buttons import Buttons
 from .ram import RAM
+from .errors import NumpyMissing
 
 
 class GameBoy:
     def __init__(self, args):
         self.cart = Cart(args.rom)
         self.ram = RAM(self.cart, debug=args.debug_ram)
-        self.cpu = CPU(self.ram, debug=args.debug_cpu)
-        self.gpu = GPU(self.cpu, debug=args.debug_gpu, headless=args.headless)
+        self.cpu = CPU(self.ram, debug=args.debug_cpu, idle_skip=args.idle_skip)
+        gpu_class = GPU
+        if args.numpy:
+            try:
+                from .gpu_numpy import NumpyGPU as gpu_class
+            except ImportError as e:
+                raise NumpyMissing(e)
         self.buttons = Buttons(self.cpu, headless=args.headless)
         self.clock = Clock(self.buttons, args.profile, args.turbo)
+        self.gpu = gpu_class(
+            self.cpu,
+            self.clock,
+            debug=args.debug_gpu,
+            headless=args.headless,
+            frameskip=args.frameskip,
+            debug_refresh=args.debug_refresh,
+        )
+        self.fast_halt = not args.no_fast_halt
+
+        # Headless, frames aren't drawn at all unless asked for - so ask
+        # for the last one, to have something to save
+        self.screenshot = args.screenshot
+        if self.screenshot and args.headless:
+            self.clock.on_last_frame = self.gpu.request_frame
 
     def run(self):
-        while True:
-            self.tick()
+        try:
+            while True:
+                self.tick()
+        finally:
+            if self.screenshot and not self.gpu.save_frame(self.screenshot):
+                print(
+                    "Couldn't save screenshot to %s: %s"
+                    % (self.screenshot, SDL_GetError().decode())
+                )
+            if self.cpu.idle_skip:
+                print(
+                    "Skipped %d idle loops, saving %d of %d cycles (%.1f%%)"
+                    % (
+                        self.cpu.idle_loops_skipped,
+                        self.cpu.idle_cycles_skipped,
+                        self.cpu.cycle,
+                        100 * self.cpu.idle_cycles_skipped / max(self.cpu.cycle, 1),
+                    )
+                )
 
     def tick(self):
-        self.cpu.tick()
-        self.gpu.tick()
-        self.buttons.tick()
-        self.clock.tick()
+        """
+        Run the CPU up until the next point where some other subsystem
+        has work to do (an LCD mode change, a timer overflow, an input
+        poll, or the start of a frame), then let each of them catch up
+        with the CPU in one go.
+        """
+        if self.fast_halt and (self.cpu.halt or self.cpu.stop):
+            # Nothing will happen until something interrupts the CPU, so
+            # skip straight there and let the GPU catch up in one go
+            gpu_event = self.gpu.next_interrupt()
+        else:
+            gpu_event = self.gpu.next_event
+        until = min(
+            self.cpu.next_event,
+            gpu_event,
+            self.buttons.next_event,
+            self.clock.next_event,
+        )
+        self.cpu.tick(until)
+        now = self.cpu.cycle
+        # The clock goes first - the start of a frame is also when the
+        # GPU decides whether to skip it, based on whether the clock is
+        # running behind as of this frame
+        self.clock.tick(now)
+        self.gpu.tick(now)
+        self.buttons.tick(now)
@@ -1,9 +1,22 @@
 from sdl2 import *
-from typing import NamedTuple
+from array import array
+from ctypes import c_char
+import sys
+from typing import Any, List, NamedTuple, Optional, Tuple
 from .consts import *
 from .cpu import CPU
+from .clock import Clock
 
 SCALE = 2
+# With --frameskip auto, always draw at least one frame in this many+1,
+# even if we're too slow to ever catch up
+MAX_AUTO_FRAMESKIP = 4
+
+# For each of the 256 possible values of a palette register (BGP, OBP0,
+# OBP1), the shade (0-3) which each colour number (0-3) is shown as
+PALETTE_SHADES: List[Tuple[int, ...]] = [
+    tuple((value >> shift) & 0x3 for shift in (0, 2, 4, 6)) for value in range(256)
+]
 
 
 class LCDC:
@@ -31,6 +44,23 @@ class Stat:
     DRAWING = 0x03
 
 
+class LineRegs(NamedTuple):
+    """
+    The LCD registers which affect rendering, as they were when a line
+    was drawn - STAT, LY, LYC and DMA are left out, since they change
+    all the time without changing what's on screen
+    """
+
+    lcdc: int
+    scy: int
+    scx: int
+    bgp: int
+    obp0: int
+    obp1: int
+    wy: int
+    wx: int
+
+
 class Sprite(NamedTuple):
     y: int
     x: int
@@ -57,18 +87,22 @@ class Sprite(NamedTuple):
         return self.flags & (1 << 3)
 
 
-rmask = 0x000000FF
-gmask = 0x0000FF00
-bmask = 0x00FF0000
-amask = 0xFF000000
-
-
 class GPU:
-    def __init__(self, cpu: CPU, debug: bool = False, headless: bool = False) -> None:
+    def __init__(
+        self,
+        cpu: CPU,
+        clock: Clock,
+        debug: bool = False,
+        headless: bool = False,
+        frameskip: int = 0,
+        debug_refresh: int = 10,
+    ) -> None:
         self.cpu = cpu
+        self.clock = clock
         self.headless = headless
         self.debug = debug
         self.cycle = 0
+        self.next_event = 0
         self.title = "RosettaBoy - " + (cpu.ram.cart.name or "<corrupt>")
 
         # Window
@@ -104,322 +138,645 @@ class GPU:
             self.hw_renderer = None
             self.hw_buffer = None
 
-        self.buffer: SDL_Surface = SDL_CreateRGBSurface(
-            0, size[0], size[1], 32, rmask, gmask, bmask, amask
+        # The screen as packed RGBA pixels, `width` pixels per row -
+        # drawn into a line at a time, and handed to SDL once per frame
+        self.width, self.height = size
+        self.framebuffer = bytearray(self.width * self.height * 4)
+        self.pixels = memoryview(self.framebuffer).cast("I")
+        self._framebuffer_ptr = (c_char * len(self.framebuffer)).from_buffer(
+            self.framebuffer
         )
-        self.renderer: SDL_Renderer = SDL_CreateSoftwareRenderer(self.buffer)
+
+        # The registers for each line of the current frame, captured as
+        # the line would be drawn - lines where nothing changed share the
+        # previous line's LineRegs. The frame is rendered from these in
+        # one go at VBLANK.
+        self.line_regs: List[Optional[LineRegs]] = [None] * 144
+        self._last_raw = bytearray()
+        self._last_regs: Optional[LineRegs] = None
+
+        # What the last frame drawn was drawn from - if nothing has
+        # changed since, the framebuffer already holds this frame
+        self._drawn_regs: List[Optional[LineRegs]] = []
+        self._drawn_oam_locked = False
+
+        # With a window, every frame is rendered. Headless, we only keep
+        # LY / STAT / interrupt timing, and render a frame only when
+        # someone asks for it with request_frame() (eg --screenshot).
+        self.frame_requested = False
+        self.rendering = False
+
+        # Frames to skip drawing after each one drawn, or -1 to skip
+        # whenever the clock says that we're running behind
+        self.frameskip = frameskip
+        self.frames_skipped = 0
+
+        # Decoded tile data - for each of the 384 tiles, 8 rows of 8
+        # colour numbers (0-3). Tiles are decoded again only when RAM
+        # tells us that they've been written to.
+        self.tiles: List[List[Tuple[int, ...]]] = [[(0,) * 8] * 8] * 384
+
+        # OAM parsed into Sprites, and for each line the sprites whose
+        # rows (up to 16 of them) overlap it, in OAM order. Rebuilt only
+        # when OAM has changed since the last frame.
+        self._oam = bytearray()
+        self.sprites: List[Sprite] = []
+        self.line_sprites: List[List[Sprite]] = [[] for _ in range(144)]
+
+        # The debug tile viewer, 32 x 12 tiles, kept separately from the
+        # framebuffer so that only tiles which have changed need to be
+        # redrawn, and that only every `debug_refresh` frames
+        self.debug_refresh = max(debug_refresh, 1)
+        self.debug_frames = 0
+        # Set when tiles or the palette have changed since the viewer was
+        # last updated, so that frames keep getting drawn until the next
+        # refresh shows the change, even if the screen itself has
+        # stopped changing
+        self._debug_pending = False
+        self.debug_image = array("I", bytes(256 * 96 * 4))
+        self._debug_drawn: List[Any] = [None] * 384
+        self._debug_palette: Optional[List[int]] = None
 
         # Colors
         self.colors = [
-            SDL_Color(r=0x9B, g=0xBC, b=0x0F, a=0xFF),
-            SDL_Color(r=0x8B, g=0xAC, b=0x0F, a=0xFF),
-            SDL_Color(r=0x30, g=0x62, b=0x30, a=0xFF),
-            SDL_Color(r=0x0F, g=0x38, b=0x0F, a=0xFF),
+            rgba(0x9B, 0xBC, 0x0F),
+            rgba(0x8B, 0xAC, 0x0F),
+            rgba(0x30, 0x62, 0x30),
+            rgba(0x0F, 0x38, 0x0F),
+        ]
+        # The four colours for every possible palette register value,
+        # so that changing palettes is a lookup rather than a rebuild
+        self.palette_colors: List[List[int]] = [
+            [self.colors[shade] for shade in shades] for shades in PALETTE_SHADES
         ]
         # printf("SDL_Init failed: %s\n", SDL_GetError())
 
+        # LY and STAT are never stored, only worked out when read
+        ram = cpu.ram
+        ram.io_read_hooks[Mem.LY] = self._read_ly
+        ram.io_read_hooks[Mem.STAT] = self._read_stat
+        ram.io_write_hooks[Mem.LCDC] = self._write_lcdc
+        ram.io_write_hooks[Mem.STAT] = self._write_stat
+        ram.io_write_hooks[Mem.LYC] = self._write_lyc
+        self._next_interrupt = sys.maxsize
+        self.schedule(0)
+
     #    GPU.~GPU():
-    #        SDL_FreeSurface(self.buffer)
     #        if(self.hw_window) SDL_DestroyWindow(self.hw_window)
     #        SDL_Quit()
 
-    def tick(self) -> None:
-        self.cycle += 1
+    def tick(self, now: int) -> None:
+        """
+        Catch up with the CPU, handling every event (interrupt or line
+        to capture) which has happened since we were last called
+        """
+        while self.next_event <= now:
+            self.cycle = self.next_event
+            self.tick_mode()
+            self.schedule(self.cycle + 1)
+
+    def next_interrupt(self) -> int:
+        """
+        The earliest cycle at which we might raise an interrupt - used
+        to fast-forward through HALT without stopping for lines which
+        only need capturing.
+        """
+        if self.cpu.stop:
+            return sys.maxsize
+        return self._next_interrupt
+
+    # <editor-fold description="Scheduling">
+    def schedule(self, start: int) -> None:
+        """
+        Work out the first cycle from `start` onwards where we have
+        something to do. LY and STAT are worked out from the cycle
+        count whenever they are read, so that only leaves VBLANK, the
+        STAT interrupts which are turned on, and (when rendering) the
+        lines to capture.
+        """
+        data = self.cpu.ram.data
+        if not (data[Mem.LCDC] & LCDC.ENABLED):
+            self.next_event = self._next_interrupt = sys.maxsize
+            return
 
+        stat = data[Mem.STAT]
+        interrupt = next_point(start, 144, 0)
+        if stat & Stat.OAM_INTERRUPT:
+            interrupt = min(interrupt, next_visible(start, 0))
+        if stat & Stat.HBLANK_INTERRUPT:
+            interrupt = min(interrupt, next_visible(start, 63))
+        if stat & Stat.LYC_INTERRUPT and data[Mem.LYC] < 154:
+            interrupt = min(interrupt, next_point(start, data[Mem.LYC], 0))
+        self._next_interrupt = interrupt
+
+        # Every line is captured at the start of drawing if we're
+        # rendering this frame - but line 0 is always needed, to decide
+        # whether to render the frame at all
+        if self.rendering:
+            self.next_event = min(interrupt, next_visible(start, 20))
+        else:
+            self.next_event = min(interrupt, next_point(start, 0, 20))
+
+    def reschedule(self) -> None:
+        """
+        A register write has changed what we need to do - work it out
+        again from now, and stop the CPU in time for it
+        """
+        self.schedule(max(self.cycle + 1, self.cpu.cycle))
+        self.cpu.end_tick_by(self.next_event)
+
+    def _write_lcdc(self, val: int) -> int:
+        self.cpu.ram.data[Mem.LCDC] = val
+        self.reschedule()
+        return val
+
+    def _write_stat(self, val: int) -> int:
+        # the LYC flag and mode bits are read-only
+        val = val & ~(Stat.LYC_EQUAL | Stat.MODE_BITS)
+        self.cpu.ram.data[Mem.STAT] = val
+        self.reschedule()
+        return val
+
+    def _write_lyc(self, val: int) -> int:
+        data = self.cpu.ram.data
+        ly = self._read_ly()
+        # LY == LYC becoming true mid-line counts as a rising edge too
+        if ly == val != data[Mem.LYC] and data[Mem.STAT] & Stat.LYC_INTERRUPT:
+            self.cpu.interrupt(Interrupt.STAT)
+        data[Mem.LYC] = val
+        self.reschedule()
+        return val
+
+    def _read_ly(self) -> int:
+        if not (self.cpu.ram.data[Mem.LCDC] & LCDC.ENABLED):
+            return 0
+        return (self.cpu.cycle // 114) % 154
+
+    def _read_stat(self) -> int:
+        data = self.cpu.ram.data
+        stat = data[Mem.STAT] & ~(Stat.LYC_EQUAL | Stat.MODE_BITS)
+        if self._read_ly() == data[Mem.LYC]:
+            stat |= Stat.LYC_EQUAL
+        if not (data[Mem.LCDC] & LCDC.ENABLED):
+            return stat | Stat.HBLANK
+        ly, lx = divmod(self.cpu.cycle % 17556, 114)
+        if ly >= 144:
+            return stat | Stat.VBLANK
+        if lx < 20:
+            return stat | Stat.OAM
+        if lx < 63:
+            return stat | Stat.DRAWING
+        return stat | Stat.HBLANK
+
+    # </editor-fold>
+
+    def tick_mode(self) -> None:
+        """
+        Handle whatever is due at this cycle
+        """
         # CPU STOP stops all LCD activity until a button is pressed
         if self.cpu.stop:
             return
 
-        # Check if LCD enabled at all
-        lcdc = self.cpu.ram[Mem.LCDC]
-        if not (lcdc & LCDC.ENABLED):
-            # When LCD is re-enabled, LY is 0
-            # Does it become 0 as soon as disabled??
-            self.cpu.ram[Mem.LY] = 0
-            if not self.debug:
-                return
-
-        lx = self.cycle % 114
-        ly = (self.cycle // 114) % 154
-        self.cpu.ram[Mem.LY] = ly
-
-        # LYC compare & interrupt
-        if self.cpu.ram[Mem.LY] == self.cpu.ram[Mem.LYC]:
-            if self.cpu.ram[Mem.STAT] & Stat.LYC_INTERRUPT:
-                self.cpu.interrupt(Interrupt.STAT)
+        ly, lx = divmod(self.cycle % 17556, 114)
+        stat = self.cpu.ram.data[Mem.STAT]
 
-            self.cpu.ram[Mem.STAT] |= Stat.LYC_EQUAL
-        else:
-            self.cpu.ram[Mem.STAT] &= ~Stat.LYC_EQUAL
-
-        # Set mode
-        if lx == 0 and ly < 144:
-            self.cpu.ram[Mem.STAT] = (
-                self.cpu.ram[Mem.STAT] & ~Stat.MODE_BITS
-            ) | Stat.OAM
+        # LYC compare & interrupt - LY only changes at the start of a
+        # line, so that's the only time LY == LYC can become true
+        if lx == 0 and ly == self.cpu.ram.data[Mem.LYC]:
+            if stat & Stat.LYC_INTERRUPT:
+                self.cpu.interrupt(Interrupt.STAT)
 
-            if self.cpu.ram[Mem.STAT] & Stat.OAM_INTERRUPT:
+        if ly < 144:
+            if lx == 0 and stat & Stat.OAM_INTERRUPT:
                 self.cpu.interrupt(Interrupt.STAT)
 
-        elif lx == 20 and ly < 144:
-            self.cpu.ram[Mem.STAT] = (
-                self.cpu.ram[Mem.STAT] & ~Stat.MODE_BITS
-            ) | Stat.DRAWING
-
-            if ly == 0:
-                # TODO: how often should we update palettes?
-                # Should every pixel reference them directly?
-                self.update_palettes()
-                c = self.bgp[0]
-                SDL_SetRenderDrawColor(self.renderer, c.r, c.g, c.b, c.a)
-                SDL_RenderClear(self.renderer)
-
-            self.draw_line(ly)
-            if ly == 143:
-                if self.debug:
-                    self.draw_debug()
-
-                if self.hw_renderer:
-                    SDL_UpdateTexture(
-                        self.hw_buffer,
-                        None,
-                        self.buffer.contents.pixels,
-                        self.buffer.contents.pitch,
+            elif lx == 20:
+                # Only decide at the top of the screen, so that we never
+                # render half a frame
+                if ly == 0:
+                    self.rendering = self.frame_requested or not (
+                        self.headless or self.skip_frame()
                     )
-                    SDL_RenderClear(self.hw_renderer)
-                    SDL_RenderCopy(self.hw_renderer, self.hw_buffer, None, None)
-                    SDL_RenderPresent(self.hw_renderer)
-
-        elif lx == 63 and ly < 144:
-            self.cpu.ram[Mem.STAT] = (
-                self.cpu.ram[Mem.STAT] & ~Stat.MODE_BITS
-            ) | Stat.HBLANK
+                if self.rendering:
+                    self.capture_line(ly)
 
-            if self.cpu.ram[Mem.STAT] & Stat.HBLANK_INTERRUPT:
+            elif lx == 63 and stat & Stat.HBLANK_INTERRUPT:
                 self.cpu.interrupt(Interrupt.STAT)
 
         elif lx == 0 and ly == 144:
-            self.cpu.ram[Mem.STAT] = (
-                self.cpu.ram[Mem.STAT] & ~Stat.MODE_BITS
-            ) | Stat.VBLANK
-
-            if self.cpu.ram[Mem.STAT] & Stat.VBLANK_INTERRUPT:
+            if stat & Stat.VBLANK_INTERRUPT:
                 self.cpu.interrupt(Interrupt.STAT)
 
             self.cpu.interrupt(Interrupt.VBLANK)
 
-    def update_palettes(self) -> None:
-        raw_bgp = self.cpu.ram[Mem.BGP]
-        self.bgp = [
-            self.colors[(raw_bgp >> 0) & 0x3],
-            self.colors[(raw_bgp >> 2) & 0x3],
-            self.colors[(raw_bgp >> 4) & 0x3],
-            self.colors[(raw_bgp >> 6) & 0x3],
-        ]
-
-        raw_obp0 = self.cpu.ram[Mem.OBP0]
-        self.obp0 = [
-            self.colors[(raw_obp0 >> 0) & 0x3],
-            self.colors[(raw_obp0 >> 2) & 0x3],
-            self.colors[(raw_obp0 >> 4) & 0x3],
-            self.colors[(raw_obp0 >> 6) & 0x3],
-        ]
-
-        raw_obp1 = self.cpu.ram[Mem.OBP1]
-        self.obp1 = [
-            self.colors[(raw_obp1 >> 0) & 0x3],
-            self.colors[(raw_obp1 >> 2) & 0x3],
-            self.colors[(raw_obp1 >> 4) & 0x3],
-            self.colors[(raw_obp1 >> 6) & 0x3],
-        ]
+            if self.rendering:
+                self.frame_requested = False
+                if self.frame_changed():
+                    self.draw_frame()
+                    self.present()
+            self.line_regs = [None] * 144
+
+    def present(self) -> None:
+        """
+        Hand the framebuffer to SDL
+        """
+        if self.hw_renderer:
+            SDL_UpdateTexture(
+                self.hw_buffer, None, self._framebuffer_ptr, self.width * 4
+            )
+            SDL_RenderClear(self.hw_renderer)
+            SDL_RenderCopy(self.hw_renderer, self.hw_buffer, None, None)
+            SDL_RenderPresent(self.hw_renderer)
+
+    def skip_frame(self) -> bool:
+        """
+        Decide whether to leave this frame undrawn - timing and
+        interrupts carry on exactly the same either way
+        """
+        if self.frameskip < 0:
+            skip = self.clock.behind and self.frames_skipped < MAX_AUTO_FRAMESKIP
+        else:
+            skip = self.frames_skipped < self.frameskip
+        self.frames_skipped = self.frames_skipped + 1 if skip else 0
+        return skip
+
+    def request_frame(self) -> None:
+        """
+        Render the next complete frame into the framebuffer, even when
+        headless - eg for a screenshot or to hash the screen
+
+        >>> from .buttons import Buttons
+        >>> cpu = CPU()
+        >>> cpu.ram[Mem.LCDC] = LCDC.ENABLED | LCDC.BG_WIN_ENABLED
+        >>> clock = Clock(Buttons(cpu, headless=True), 0, False)
+        >>> gpu = GPU(cpu, clock, headless=True)
+        >>> gpu.tick(17556 * 2)
+        >>> any(gpu.framebuffer)
+        False
+        >>> gpu.request_frame()
+        >>> gpu.tick(17556 * 4)
+        >>> any(gpu.framebuffer)
+        True
+        """
+        self.frame_requested = True
+
+    def save_frame(self, path: str) -> bool:
+        """
+        Write the framebuffer out to a BMP file, returning whether
+        that worked (SDL_GetError() says why not)
+        """
+        surface = SDL_CreateRGBSurfaceWithFormatFrom(
+            self._framebuffer_ptr,
+            self.width,
+            self.height,
+            32,
+            self.width * 4,
+            SDL_PIXELFORMAT_ABGR8888,
+        )
+        if not surface:
+            return False
+        ok = SDL_SaveBMP(surface, path.encode()) == 0
+        SDL_FreeSurface(surface)
+        return ok
+
+    def capture_line(self, ly: int) -> None:
+        """
+        Remember the LCD registers for this line, to draw it with later
+        """
+        data = self.cpu.ram.data
+        raw = (
+            data[Mem.LCDC : Mem.LCDC + 1]
+            + data[Mem.SCY : Mem.LY]
+            + data[Mem.BGP : Mem.WX + 1]
+        )
+        if raw != self._last_raw:
+            self._last_raw = raw
+            self._last_regs = LineRegs._make(raw)
+        self.line_regs[ly] = self._last_regs
+
+    def frame_changed(self) -> bool:
+        """
+        Check whether this frame would look any different to the last
+        one drawn - RAM tracks writes which change VRAM and OAM, and
+        the captured registers cover everything else - or whether the
+        debug viewer is still behind an earlier one
+        """
+        ram = self.cpu.ram
+        if self.debug and ram.dirty_tiles:
+            self._debug_pending = True
+        if (
+            ram.video_changed
+            or ram.dirty_tiles
+            or self.line_regs != self._drawn_regs
+            or ram.oam_locked != self._drawn_oam_locked
+            or self._debug_pending
+        ):
+            ram.video_changed = False
+            self._drawn_regs = self.line_regs
+            self._drawn_oam_locked = ram.oam_locked
+            return True
+        return False
+
+    def draw_frame(self) -> None:
+        """
+        Render every line captured since the last frame. Lines which
+        weren't captured (eg the LCD was off) keep their old contents.
+        """
+        self.update_sprites()
+        last = None
+        for ly, regs in enumerate(self.line_regs):
+            if regs is None:
+                continue
+            if regs is not last:
+                self.update_palettes(regs)
+                if last is None and self.debug:
+                    self.fill_rect(0, 0, self.width, self.height, self.bgp[0])
+                last = regs
+            self.draw_line(ly, regs)
+
+        if self.debug and last:
+            self.draw_debug()
+
+    def update_sprites(self) -> None:
+        """
+        Parse OAM, if it has changed, and sort the sprites into the
+        lines which they could appear on
+        """
+        oam = self.cpu.ram.data[Mem.OAM_BASE : Mem.OAM_BASE + 160]
+        if oam == self._oam:
+            return
+        self._oam = oam
+        self.sprites = [Sprite(*oam[n : n + 4]) for n in range(0, 160, 4)]
+        self.line_sprites = [[] for _ in range(144)]
+        for sprite in self.sprites:
+            top = sprite.y - 16
+            for ly in range(max(top, 0), min(top + 16, 144)):
+                self.line_sprites[ly].append(sprite)
+
+    def sprites_on_line(self, ly: int, height: int) -> List[Sprite]:
+        """
+        The first 10 sprites in OAM which overlap this line - the
+        hardware can't show any more than that. Sprites which are off
+        the side of the screen still count towards the 10.
+        """
+        if height == 16:
+            return self.line_sprites[ly][:10]
+        return [s for s in self.line_sprites[ly] if ly - s.y < -8][:10]
+
+    def update_palettes(self, regs: LineRegs) -> None:
+        self.bgp = self.palette_colors[regs.bgp]
+        self.obp0 = self.palette_colors[regs.obp0]
+        self.obp1 = self.palette_colors[regs.obp1]
 
     def draw_debug(self) -> None:
         lcdc = self.cpu.ram[Mem.LCDC]
 
         # Tile data
-        tile_display_width = 32
-        for tile_id in range(0, 384):
-            xy = SDL_Point(
-                x=160 + (tile_id % tile_display_width) * 8,
-                y=(tile_id // tile_display_width) * 8,
-            )
-
-            self.paint_tile(tile_id, xy, self.bgp, False, False)
+        self.draw_debug_tiles()
 
         # Background scroll border
         if lcdc & LCDC.BG_WIN_ENABLED:
-            rect = SDL_Rect(x=0, y=0, w=160, h=144)
-            SDL_SetRenderDrawColor(self.renderer, 255, 0, 0, 0xFF)
-            SDL_RenderDrawRect(self.renderer, rect)
+            self.draw_rect(0, 0, 160, 144, rgba(255, 0, 0))
 
         # Window tiles
         if lcdc & LCDC.WINDOW_ENABLED:
             wnd_y = self.cpu.ram[Mem.WY]
             wnd_x = self.cpu.ram[Mem.WX]
-            rect = SDL_Rect(x=wnd_x - 7, y=wnd_y, w=160, h=144)
-            SDL_SetRenderDrawColor(self.renderer, 0, 0, 255, 0xFF)
-            SDL_RenderDrawRect(self.renderer, rect)
-
-    def draw_line(self, ly: int) -> None:
-        lcdc = self.cpu.ram[Mem.LCDC]
+            self.draw_rect(wnd_x - 7, wnd_y, 160, 144, rgba(0, 0, 255))
+
+    def draw_debug_tiles(self) -> None:
+        """
+        Show all 384 tiles to the right of the screen
+        """
+        if self.bgp is not self._debug_palette:
+            self._debug_pending = True
+        if self._debug_pending and self.debug_frames % self.debug_refresh == 0:
+            self.update_debug_tiles()
+            self._debug_pending = False
+        self.debug_frames += 1
+
+        image = self.debug_image
+        for y in range(0, 96):
+            start = y * self.width + 160
+            self.pixels[start : start + 256] = image[y * 256 : y * 256 + 256]
+
+    def update_debug_tiles(self) -> None:
+        """
+        Redraw any tiles in the debug viewer which have been decoded
+        again since they were last drawn, or all of them if the
+        palette has changed
+        """
+        if self.bgp is not self._debug_palette:
+            self._debug_palette = self.bgp
+            self._debug_drawn = [None] * 384
+        image = self.debug_image
+        for tile_id, rows in enumerate(self.tiles):
+            if rows is self._debug_drawn[tile_id]:
+                continue
+            self._debug_drawn[tile_id] = rows
+            hue = gen_hue(tile_id)
+            start = (tile_id // 32) * 8 * 256 + (tile_id % 32) * 8
+            for y in range(0, 8):
+                if y == 0 or y == 7:
+                    pixels = [hue] * 8
+                else:
+                    pixels = self.tile_line(tile_id, y, self.bgp)
+                    pixels[0] = pixels[7] = hue
+                image[start : start + 8] = array("I", pixels)
+                start += 256
+
+    def draw_line(self, ly: int, regs: LineRegs) -> None:
+        """
+        Render one line of the screen into the framebuffer - background,
+        then window, then any sprites which overlap this line
+        """
+        ram = self.cpu.ram
+        vram = ram.data
+        lcdc = regs.lcdc
+        if ram.dirty_tiles:
+            self.update_tiles()
+        line = [self.bgp[0]] * 160
+        outlines: List[Tuple[int, int, int]] = []
 
         # Background tiles
         if lcdc & LCDC.BG_WIN_ENABLED:
-            scroll_y = self.cpu.ram[Mem.SCY]
-            scroll_x = self.cpu.ram[Mem.SCX]
+            scroll_y = regs.scy
+            scroll_x = regs.scx
             tile_offset = not (lcdc & LCDC.DATA_SRC)
             tile_map = Mem.MAP_1 if (lcdc & LCDC.BG_MAP) else Mem.MAP_0
 
             if self.debug:
-                xy = SDL_Point(x=256 - scroll_x, y=ly)
-                SDL_SetRenderDrawColor(self.renderer, 255, 0, 0, 0xFF)
-                SDL_RenderDrawPoint(self.renderer, xy.x, xy.y)
+                self.fill_rect(256 - scroll_x, ly, 1, 1, rgba(255, 0, 0))
 
             y_in_bgmap = (ly + scroll_y) % 256
             tile_y = y_in_bgmap // 8
             tile_sub_y = y_in_bgmap % 8
 
-            for lx in range(0, 160 + 1, 8):
-                x_in_bgmap = (lx + scroll_x) % 256
-                tile_x = x_in_bgmap // 8
-                tile_sub_x = x_in_bgmap % 8
-
-                tile_id = self.cpu.ram[tile_map + tile_y * 32 + tile_x]
+            # 21 tiles cover the screen however it's scrolled, then
+            # trim off the part of the first tile that's off-screen
+            row = tile_map + tile_y * 32
+            first = scroll_x // 8
+            pixels: List[int] = []
+            for tile_x in range(first, first + 21):
+                tile_id = vram[row + tile_x % 32]
                 if tile_offset and tile_id < 0x80:
                     tile_id += 0x100
-
-                xy = SDL_Point(
-                    x=lx - tile_sub_x,
-                    y=ly - tile_sub_y,
-                )
-
-                self.paint_tile_line(tile_id, xy, self.bgp, False, False, tile_sub_y)
+                pixels += self.tile_line(tile_id, tile_sub_y, self.bgp)
+            line = pixels[scroll_x % 8 : scroll_x % 8 + 160]
 
         # Window tiles
-        if lcdc & LCDC.WINDOW_ENABLED:
-            wnd_y = self.cpu.ram[Mem.WY]
-            wnd_x = self.cpu.ram[Mem.WX]
+        wnd_y = regs.wy
+        # WX > 166 puts the window entirely off-screen
+        if lcdc & LCDC.WINDOW_ENABLED and ly >= wnd_y and regs.wx < 167:
+            wnd_x = regs.wx - 7
             tile_offset = not (lcdc & LCDC.DATA_SRC)
             tile_map = Mem.MAP_1 if (lcdc & LCDC.WINDOW_MAP) else Mem.MAP_0
 
-            # blank out the background
-            rect = SDL_Rect(
-                x=wnd_x - 7,
-                y=wnd_y,
-                w=160,
-                h=144,
-            )
-
-            c = self.bgp[0]
-            SDL_SetRenderDrawColor(self.renderer, c.r, c.g, c.b, c.a)
-            SDL_RenderFillRect(self.renderer, rect)
-
             y_in_bgmap = ly - wnd_y
             tile_y = y_in_bgmap // 8
             tile_sub_y = y_in_bgmap % 8
 
+            row = tile_map + tile_y * 32
+            pixels = []
             for tile_x in range(0, 20):
-                tile_id = self.cpu.ram[tile_map + tile_y * 32 + tile_x]
+                tile_id = vram[row + tile_x]
                 if tile_offset and tile_id < 0x80:
                     tile_id += 0x100
+                pixels += self.tile_line(tile_id, tile_sub_y, self.bgp)
 
-                xy = SDL_Point(
-                    x=tile_x * 8 + wnd_x - 7,
-                    y=tile_y * 8 + wnd_y,
-                )
-
-                self.paint_tile_line(tile_id, xy, self.bgp, False, False, tile_sub_y)
+            # the window covers everything to the right of wnd_x
+            start, end = max(wnd_x, 0), min(wnd_x + 160, 160)
+            line[start:end] = pixels[start - wnd_x : end - wnd_x]
 
         # Sprites
-        if lcdc & LCDC.OBJ_ENABLED:
-            dbl = lcdc & LCDC.OBJ_SIZE
+        if lcdc & LCDC.OBJ_ENABLED and not ram.oam_locked:
+            height = 16 if lcdc & LCDC.OBJ_SIZE else 8
 
             # TODO: sorted by x
-            # auto sprites: [Sprite 40] = []
-            # memcpy(sprites, &ram.data[OAM_BASE], 40 * sizeof(Sprite))
-            # for sprite in sprites.iter():
-            for n in range(0, 40):
-                sprite = Sprite(
-                    y=self.cpu.ram[Mem.OAM_BASE + 4 * n + 0],
-                    x=self.cpu.ram[Mem.OAM_BASE + 4 * n + 1],
-                    tile_id=self.cpu.ram[Mem.OAM_BASE + 4 * n + 2],
-                    flags=self.cpu.ram[Mem.OAM_BASE + 4 * n + 3],
+            for sprite in self.sprites_on_line(ly, height):
+                if not sprite.is_live():
+                    continue
+                # which row of the sprite is on this line
+                y = ly - (sprite.y - 16)
+
+                # 8x16 sprites are two tiles, one above the other
+                tile_id = sprite.tile_id + (y >> 3)
+                y &= 7
+                palette = self.obp1 if sprite.palette else self.obp0
+                # printf("Drawing sprite %d (from %04X) at %d,%d\n", tile_id, OAM_BASE + (sprite_id * 4) + 0, x, y)
+                pixels = self.tile_line(
+                    tile_id, 7 - y if sprite.y_flip else y, palette, True
                 )
+                if sprite.x_flip:
+                    pixels.reverse()
+                x = sprite.x - 8
+                for px in pixels:
+                    # pallette #0 = transparent, so don't draw anything
+                    if px is not None and 0 <= x < 160:
+                        line[x] = px
+                    x += 1
 
-                if sprite.is_live():
-                    palette = self.obp1 if sprite.palette else self.obp0
-                    # printf("Drawing sprite %d (from %04X) at %d,%d\n", tile_id, OAM_BASE + (sprite_id * 4) + 0, x, y)
-                    xy = SDL_Point(
-                        x=sprite.x - 8,
-                        y=sprite.y - 16,
-                    )
-
-                    self.paint_tile(
-                        sprite.tile_id, xy, palette, sprite.x_flip, sprite.y_flip
+                if self.debug:
+                    outlines.append((sprite.x - 8, y, gen_hue(tile_id)))
+
+        start = ly * self.width
+        self.pixels[start : start + 160] = array("I", line)
+
+        # Outline each sprite tile
+        for x, y, c in outlines:
+            if y == 0 or y == 7:
+                self.fill_rect(x, ly, 8, 1, c)
+            else:
+                self.fill_rect(x, ly, 1, 1, c)
+                self.fill_rect(x + 7, ly, 1, 1, c)
+
+    def update_tiles(self) -> None:
+        """
+        Decode any tiles which have been written to since last time
+        """
+        data = self.cpu.ram.data
+        for tile_id in self.cpu.ram.dirty_tiles:
+            rows = []
+            for y in range(0, 8):
+                addr = Mem.TILE_DATA + tile_id * 16 + y * 2
+                low_byte = data[addr]
+                high_byte = data[addr + 1]
+                rows.append(
+                    tuple(
+                        ((high_byte >> (7 - x)) & 0x01) << 1
+                        | (low_byte >> (7 - x)) & 0x01
+                        for x in range(0, 8)
                     )
-
-                    if dbl:
-                        xy.y = sprite.y - 8
-                        self.paint_tile(
-                            sprite.tile_id + 1,
-                            xy,
-                            palette,
-                            sprite.x_flip,
-                            sprite.y_flip,
-                        )
-
-    def paint_tile(
-        self,
-        tile_id: int,
-        offset: SDL_Point,
-        palette: SDL_Color,
-        flip_x: bool,
-        flip_y: bool,
-    ) -> None:
-        for y in range(0, 8):
-            self.paint_tile_line(tile_id, offset, palette, flip_x, flip_y, y)
-
-        if self.debug:
-            rect = SDL_Rect(
-                x=offset.x,
-                y=offset.y,
-                w=8,
-                h=8,
-            )
-
-            c = gen_hue(tile_id)
-            SDL_SetRenderDrawColor(self.renderer, c.r, c.g, c.b, c.a)
-            SDL_RenderDrawRect(self.renderer, rect)
-
-    def paint_tile_line(
-        self,
-        tile_id: int,
-        offset: SDL_Point,
-        palette: SDL_Color,
-        flip_x: bool,
-        flip_y: bool,
-        y: int,
-    ) -> None:
-        addr = Mem.TILE_DATA + tile_id * 16 + y * 2
-        low_byte = self.cpu.ram[addr]
-        high_byte = self.cpu.ram[addr + 1]
-        for x in range(0, 8):
-            low_bit = (low_byte >> (7 - x)) & 0x01
-            high_bit = (high_byte >> (7 - x)) & 0x01
-            px = (high_bit << 1) | low_bit
-            # pallette #0 = transparent, so don't draw anything
-            if px > 0:
-                xy = SDL_Point(
-                    x=offset.x + (7 - x if flip_x else x),
-                    y=offset.y + (7 - y if flip_y else y),
                 )
-
-                c = palette[px]
-                SDL_SetRenderDrawColor(self.renderer, c.r, c.g, c.b, c.a)
-                SDL_RenderDrawPoint(self.renderer, xy.x, xy.y)
-
-
-def gen_hue(n: int) -> SDL_Color:
+            self.tiles[tile_id] = rows
+        self.cpu.ram.dirty_tiles.clear()
+
+    def tile_line(
+        self, tile_id: int, y: int, palette: List[int], transparent: bool = False
+    ) -> List[Optional[int]]:
+        """
+        The colours of the 8 pixels in row `y` of a tile - with colour
+        #0 as None if `transparent`
+        """
+        row = self.tiles[tile_id][y]
+        if not transparent:
+            return [palette[px] for px in row]
+        colors: List[Optional[int]] = [None, palette[1], palette[2], palette[3]]
+        return [colors[px] for px in row]
+
+    def fill_rect(self, x: int, y: int, w: int, h: int, c: int) -> None:
+        """
+        Fill a rectangle of the framebuffer, clipped to the screen
+        """
+        x0, x1 = max(x, 0), min(x + w, self.width)
+        y0, y1 = max(y, 0), min(y + h, self.height)
+        if x0 >= x1:
+            return
+        row = array("I", [c]) * (x1 - x0)
+        for py in range(y0, y1):
+            self.pixels[py * self.width + x0 : py * self.width + x1] = row
+
+    def draw_rect(self, x: int, y: int, w: int, h: int, c: int) -> None:
+        """
+        Draw the outline of a rectangle, like SDL_RenderDrawRect
+        """
+        self.fill_rect(x, y, w, 1, c)
+        self.fill_rect(x, y + h - 1, w, 1, c)
+        self.fill_rect(x, y, 1, h, c)
+        self.fill_rect(x + w - 1, y, 1, h, c)
+
+
+def next_point(start: int, ly: int, lx: int) -> int:
+    """
+    The first cycle from `start` onwards which is `lx` cycles into
+    line `ly` of a frame
+    """
+    return start + (ly * 114 + lx - start) % 17556
+
+
+def next_visible(start: int, lx: int) -> int:
+    """
+    The first cycle from `start` onwards which is `lx` cycles into one
+    of the 144 visible lines
+    """
+    ly, x = divmod(start % 17556, 114)
+    if x > lx:
+        ly += 1
+    if ly >= 144:
+        # line 0 of the next frame
+        ly = 154
+    return start - start % 17556 + ly * 114 + lx
+
+
+def rgba(r: int, g: int, b: int, a: int = 0xFF) -> int:
+    """
+    Pack a colour the way the framebuffer stores it
+    """
+    return r | g << 8 | b << 16 | a << 24
+
+
+def gen_hue(n: int) -> int:
     region = n // 43
     remainder = (n - (region * 43)) * 6
 
@@ -427,13 +784,13 @@ def gen_hue(n: int) -> SDL_Color:
     t = remainder
 
     if region == 0:
-        return SDL_Color(r=255, g=t, b=0, a=0xFF)
+        return rgba(255, t, 0)
     if region == 1:
-        return SDL_Color(r=q, g=255, b=0, a=0xFF)
+        return rgba(q, 255, 0)
     if region == 2:
-        return SDL_Color(r=0, g=255, b=t, a=0xFF)
+        return rgba(0, 255, t)
     if region == 3:
-        return SDL_Color(r=0, g=q, b=255, a=0xFF)
+        return rgba(0, q, 255)
     if region == 4:
-        return SDL_Color(r=t, g=0, b=255, a=0xFF)
-    return SDL_Color(r=255, g=0, b=q, a=0xFF)
+        return rgba(t, 0, 255)
+    return rgba(255, 0, q)
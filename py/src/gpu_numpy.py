@@ -0,0 +1,253 @@
+"""
+A GPU which renders with NumPy array operations instead of Python
+loops - same output as GPU, selected with --numpy.
+"""
+
+import numpy as np
+from typing import List, Tuple
+
+from .consts import *
+from .cpu import CPU
+from .clock import Clock
+from .gpu import GPU, LCDC, LineRegs, gen_hue, rgba
+
+
+class NumpyGPU(GPU):
+    def __init__(
+        self,
+        cpu: CPU,
+        clock: Clock,
+        debug: bool = False,
+        headless: bool = False,
+        frameskip: int = 0,
+        debug_refresh: int = 10,
+    ) -> None:
+        super().__init__(cpu, clock, debug, headless, frameskip, debug_refresh)
+
+        # Views onto RAM and the framebuffer, no copying
+        self.vram = np.frombuffer(cpu.ram.data, dtype=np.uint8)
+        self.screen = np.frombuffer(self.framebuffer, dtype=np.uint32).reshape(
+            (self.height, self.width)
+        )
+
+        # (256, 4) - the colours for each palette register value
+        self.palette_colors_np = np.array(self.palette_colors, dtype=np.uint32)
+
+        # 384 tiles x 8 rows x 8 colour numbers
+        self.tiles = np.zeros((384, 8, 8), dtype=np.uint8)
+
+        # The tile viewer as (row, column, y, x) - a view onto the
+        # image, with the tiles it was last drawn from, and where each
+        # tile's outline goes and what colour it is
+        self.debug_tiles = (
+            np.frombuffer(self.debug_image, dtype=np.uint32)
+            .reshape((12, 8, 32, 8))
+            .transpose((0, 2, 1, 3))
+        )
+        self._debug_tiles = self.tiles.copy()
+        self.debug_border = np.zeros((8, 8), dtype=bool)
+        self.debug_border[[0, 7], :] = True
+        self.debug_border[:, [0, 7]] = True
+        self.debug_hues = np.array([gen_hue(n) for n in range(384)], dtype=np.uint32)
+
+    def update_palettes(self, regs: LineRegs) -> None:
+        super().update_palettes(regs)
+        self.bgp_np = self.palette_colors_np[regs.bgp]
+        self.obp0_np = self.palette_colors_np[regs.obp0]
+        self.obp1_np = self.palette_colors_np[regs.obp1]
+
+    def update_tiles(self) -> None:
+        """
+        Decode any tiles which have been written to since last time -
+        unpacking each tile's 16 bytes into bits, then combining the
+        low and high bit-planes
+        """
+        dirty = np.fromiter(self.cpu.ram.dirty_tiles, dtype=np.intp)
+        self.cpu.ram.dirty_tiles.clear()
+        data = self.vram[Mem.TILE_DATA : Mem.TILE_DATA + 384 * 16].reshape((384, 8, 2))
+        bits = np.unpackbits(data[dirty], axis=2)
+        self.tiles[dirty] = bits[:, :, 8:] << 1 | bits[:, :, :8]
+
+    def tile_ids(self, addr: int, count: int, lcdc: int, first: int = 0) -> np.ndarray:
+        """
+        `count` tile IDs from the map row at `addr`, starting at column
+        `first` and wrapping around
+        """
+        ids = self.vram[addr + (np.arange(first, first + count) % 32)].astype(np.intp)
+        if not (lcdc & LCDC.DATA_SRC):
+            ids[ids < 0x80] += 0x100
+        return ids
+
+    def update_debug_tiles(self) -> None:
+        if self.bgp is not self._debug_palette:
+            self._debug_palette = self.bgp
+            changed = np.ones(384, dtype=bool)
+        else:
+            changed = (self.tiles != self._debug_tiles).any(axis=(1, 2))
+        ids = np.flatnonzero(changed)
+        if not len(ids):
+            return
+        self._debug_tiles[ids] = self.tiles[ids]
+        pixels = self.bgp_np.take(self.tiles[ids])
+        pixels[:, self.debug_border] = self.debug_hues[ids, np.newaxis]
+        self.debug_tiles[ids // 32, ids % 32] = pixels
+
+    def draw_frame(self) -> None:
+        """
+        Render all the captured lines of the frame at once - each step
+        works on a (line, x) array covering the whole screen
+        """
+        if self.debug:
+            # the debug overlays are drawn a line at a time
+            return super().draw_frame()
+
+        captured = np.array([regs is not None for regs in self.line_regs])
+        if not captured.any():
+            return
+        # uncaptured lines get dummy registers, and aren't written out
+        blank = LineRegs(*([0] * len(LineRegs._fields)))
+        regs = np.array([r or blank for r in self.line_regs], dtype=np.intp).T[
+            :, :, np.newaxis
+        ]
+        lcdc, scy, scx, bgp, obp0, obp1, wy, wx = regs
+        ram = self.cpu.ram
+        if ram.dirty_tiles:
+            self.update_tiles()
+        ly = np.arange(144)[:, np.newaxis]
+        x = np.arange(160)[np.newaxis, :]
+
+        def tile_pixels(tile_map, map_y, map_x):
+            ids = self.vram[tile_map + (map_y // 8) * 32 + map_x // 8].astype(np.intp)
+            ids[(ids < 0x80) & ~(lcdc & LCDC.DATA_SRC).astype(bool)] += 0x100
+            return self.tiles[ids, map_y % 8, map_x % 8]
+
+        # Background tiles
+        tile_map = np.where(lcdc & LCDC.BG_MAP, Mem.MAP_1, Mem.MAP_0)
+        pixels = tile_pixels(tile_map, (ly + scy) % 256, (x + scx) % 256)
+        pixels[(lcdc & LCDC.BG_WIN_ENABLED == 0)[:, 0]] = 0
+
+        # Window tiles - the window covers everything to the right of wx-7
+        win_x = x - (wx - 7)
+        win_y = ly - wy
+        window = (
+            (lcdc & LCDC.WINDOW_ENABLED > 0)
+            & (win_y >= 0)
+            & (win_x >= 0)
+            & (win_x < 160)
+        )
+        tile_map = np.where(lcdc & LCDC.WINDOW_MAP, Mem.MAP_1, Mem.MAP_0)
+        win_pixels = tile_pixels(
+            tile_map, np.where(win_y >= 0, win_y, 0), np.clip(win_x, 0, 159)
+        )
+        pixels = np.where(window, win_pixels, pixels)
+        line = np.take_along_axis(self.palette_colors_np[bgp[:, 0]], pixels, axis=1)
+
+        # Sprites - one at a time, so later ones go on top
+        if not ram.oam_locked:
+            obp = self.palette_colors_np[np.stack([obp0[:, 0], obp1[:, 0]])]
+            height = np.where(lcdc & LCDC.OBJ_SIZE, 16, 8)[:, 0]
+            enabled = (lcdc & LCDC.OBJ_ENABLED > 0)[:, 0]
+            # how many sprites each line has had so far - the hardware
+            # shows the first 10, even if some are off the side
+            count = np.zeros(144, dtype=np.intp)
+            self.update_sprites()
+            for sprite in self.sprites:
+                # the lines which this sprite could be on
+                top = sprite.y - 16
+                rows = np.arange(max(top, 0), min(top + 16, 144))
+                y = rows - top
+                rows_on = (y < height[rows]) & (count[rows] < 10)
+                count[rows] += rows_on
+                rows_on &= enabled[rows]
+                if not (sprite.is_live() and rows_on.any()):
+                    continue
+
+                # 8x16 sprites are two tiles, one above the other
+                tile_rows = 7 - (y & 7) if sprite.y_flip else y & 7
+                pixels = self.tiles[sprite.tile_id + (y >> 3), tile_rows]
+                if sprite.x_flip:
+                    pixels = pixels[:, ::-1]
+                xs = np.arange(sprite.x - 8, sprite.x)
+                cols = (xs >= 0) & (xs < 160)
+                pixels = pixels[:, cols]
+                # pallette #0 = transparent, so don't draw anything
+                mask = (pixels > 0) & rows_on[:, np.newaxis]
+                colors = np.take_along_axis(
+                    obp[1 if sprite.palette else 0][rows], pixels, axis=1
+                )
+                area = np.ix_(rows, xs[cols])
+                line[area] = np.where(mask, colors, line[area])
+
+        self.screen[captured, 0:160] = line[captured]
+
+    def draw_line(self, ly: int, regs: LineRegs) -> None:
+        ram = self.cpu.ram
+        lcdc = regs.lcdc
+        if ram.dirty_tiles:
+            self.update_tiles()
+        line = np.full(160, self.bgp[0], dtype=np.uint32)
+        outlines: List[Tuple[int, int, int]] = []
+
+        # Background tiles
+        if lcdc & LCDC.BG_WIN_ENABLED:
+            scroll_y = regs.scy
+            scroll_x = regs.scx
+            tile_map = Mem.MAP_1 if (lcdc & LCDC.BG_MAP) else Mem.MAP_0
+
+            if self.debug:
+                self.fill_rect(256 - scroll_x, ly, 1, 1, rgba(255, 0, 0))
+
+            y_in_bgmap = (ly + scroll_y) % 256
+            ids = self.tile_ids(
+                tile_map + (y_in_bgmap // 8) * 32, 21, lcdc, scroll_x // 8
+            )
+            pixels = self.tiles[ids, y_in_bgmap % 8].ravel()
+            line = self.bgp_np.take(pixels[scroll_x % 8 : scroll_x % 8 + 160])
+
+        # Window tiles
+        wnd_y = regs.wy
+        # WX > 166 puts the window entirely off-screen
+        if lcdc & LCDC.WINDOW_ENABLED and ly >= wnd_y and regs.wx < 167:
+            wnd_x = regs.wx - 7
+            tile_map = Mem.MAP_1 if (lcdc & LCDC.WINDOW_MAP) else Mem.MAP_0
+
+            y_in_bgmap = ly - wnd_y
+            ids = self.tile_ids(tile_map + (y_in_bgmap // 8) * 32, 20, lcdc)
+            pixels = self.tiles[ids, y_in_bgmap % 8].ravel()
+
+            # the window covers everything to the right of wnd_x
+            start, end = max(wnd_x, 0), min(wnd_x + 160, 160)
+            line[start:end] = self.bgp_np.take(pixels[start - wnd_x : end - wnd_x])
+
+        # Sprites
+        if lcdc & LCDC.OBJ_ENABLED and not ram.oam_locked:
+            height = 16 if lcdc & LCDC.OBJ_SIZE else 8
+
+            # draw them in order, so later ones go on top
+            for sprite in self.sprites_on_line(ly, height):
+                if not sprite.is_live():
+                    continue
+                y = ly - (sprite.y - 16)
+                tile_id = sprite.tile_id + (y >> 3)
+                y &= 7
+                palette = self.obp1_np if sprite.palette else self.obp0_np
+                pixels = self.tiles[tile_id, 7 - y if sprite.y_flip else y]
+                if sprite.x_flip:
+                    pixels = pixels[::-1]
+                x = np.arange(sprite.x - 8, sprite.x)
+                # pallette #0 = transparent, so don't draw anything
+                mask = (pixels > 0) & (x >= 0) & (x < 160)
+                line[x[mask]] = palette.take(pixels[mask])
+
+                if self.debug:
+                    outlines.append((sprite.x - 8, y, gen_hue(tile_id)))
+
+        self.screen[ly, 0:160] = line
+
+        # Outline each sprite tile
+        for x, y, c in outlines:
+            if y == 0 or y == 7:
+                self.fill_rect(x, ly, 8, 1, c)
+            else:
+                self.fill_rect(x, ly, 1, 1, c)
+                self.fill_rect(x + 7, ly, 1, 1, c)
@@ -1,4 +1,4 @@
-from typing import List
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 from .cart import Cart
 from .consts import *
 
@@ -6,13 +6,134 @@ ROM_BANK_SIZE = 0x4000
 RAM_BANK_SIZE = 0x2000
 
 
+class Handler:
+    """
+    A page of the memory map which needs more than a plain buffer
+    lookup, eg I/O registers or the MBC - looks like a buffer to RAM,
+    but passes the address to functions
+    """
+
+    __slots__ = ("get", "set")
+
+    def __init__(
+        self, get: Callable[[int], int], set: Callable[[int, int], None]
+    ) -> None:
+        self.get = get
+        self.set = set
+
+    def __getitem__(self, addr: int) -> int:
+        return self.get(addr)
+
+    def __setitem__(self, addr: int, val: int) -> None:
+        self.set(addr, val)
+
+
+class IOPage:
+    """
+    0xFF00 - 0xFFFF: I/O registers (which may be hooked), High RAM
+    (which may hold compiled code) and the IE register. This page is
+    hit often enough that it gets its own class rather than a Handler.
+    """
+
+    __slots__ = ("ram", "data", "read_hooks", "write_hooks")
+
+    def __init__(self, ram: "RAM") -> None:
+        self.ram = ram
+        self.data = ram.data
+        self.read_hooks = ram.io_read_hooks
+        self.write_hooks = ram.io_write_hooks
+
+    def __getitem__(self, addr: int) -> int:
+        if addr < 0xFF80:
+            # IO Registers
+            hook = self.read_hooks.get(addr)
+            if hook:
+                return hook()
+        # High RAM / IE Register
+        return self.data[addr]
+
+    def __setitem__(self, addr: int, val: int) -> None:
+        if addr < 0xFF80 or addr == Mem.IE:
+            # IO Registers (and IE, which the CPU watches)
+            # if addr == Mem.:SCX as u16 {
+            #     println!("LY = {}, SCX = {}", self.get(Mem.:LY), val);
+            # }
+            hook = self.write_hooks.get(addr)
+            if hook:
+                val = hook(val)
+        elif self.ram.code_map[addr]:
+            # High RAM
+            self.ram.code_write_hook(addr)
+        self.data[addr] = val
+
+
+class CodePage:
+    """
+    Write-side of a page of work RAM which we've compiled code from
+    """
+
+    __slots__ = ("ram", "data")
+
+    def __init__(self, ram: "RAM") -> None:
+        self.ram = ram
+        self.data = ram.data
+
+    def __setitem__(self, addr: int, val: int) -> None:
+        self.data[addr] = val
+        if self.ram.code_map[addr]:
+            self.ram.code_write_hook(addr)
+
+
+class TilePage:
+    """
+    Write-side of the tile data in VRAM (0x8000 - 0x9800) - notes which
+    tiles have been written to, so the GPU knows to decode them again
+    """
+
+    __slots__ = ("data", "dirty_tiles")
+
+    def __init__(self, ram: "RAM") -> None:
+        self.data = ram.data
+        self.dirty_tiles = ram.dirty_tiles
+
+    def __setitem__(self, addr: int, val: int) -> None:
+        if self.data[addr] != val:
+            self.data[addr] = val
+            self.dirty_tiles.add((addr - Mem.TILE_DATA) >> 4)
+
+
+class VideoPage:
+    """
+    Write-side of the tile maps (0x9800 - 0xA000) and OAM - notes when
+    something on screen might have changed
+    """
+
+    __slots__ = ("ram", "data")
+
+    def __init__(self, ram: "RAM") -> None:
+        self.ram = ram
+        self.data = ram.data
+
+    def __setitem__(self, addr: int, val: int) -> None:
+        if self.data[addr] != val:
+            self.data[addr] = val
+            self.ram.video_changed = True
+
+
 class RAM:
     def __init__(self, cart: Cart, debug: bool = False) -> None:
         self.cart = cart
         self.boot = self.get_boot()
-        self.data = [0] * (0xFFFF + 1)
+        self.data = bytearray(0xFFFF + 1)
         self.debug = debug
 
+        # The whole address space is backed by one bytearray, and the
+        # cart's ROM and RAM are accessed through memoryviews, so bulk
+        # copies (DMA, snapshots, handing VRAM to the renderer) are
+        # slices rather than loops
+        self.rom = memoryview(cart.data)
+        self.cart_ram = memoryview(cart.ram)
+
         self.ram_enable = True
         self.ram_bank_mode = False
         self.rom_bank_low = 1
@@ -20,6 +141,31 @@ class RAM:
         self.rom_bank = 1
         self.ram_bank = 0
 
+        # Other subsystems can hook reads of I/O registers whose value
+        # is computed on demand, and writes to I/O registers - the write
+        # hook is given the value being written, and returns the value
+        # which should actually be stored
+        self.io_read_hooks: Dict[int, Callable[[], int]] = {}
+        self.io_write_hooks: Dict[int, Callable[[int], int]] = {}
+
+        # Ranges of RAM which the CPU has compiled code from (start ->
+        # end), and how many of them cover each address - if a covered
+        # address is written to, the code needs recompiling
+        self.code_ranges: Dict[int, int] = {}
+        self.code_map = bytearray(0xFFFF + 1)
+        self.code_write_hook: Optional[Callable[[int], None]] = None
+
+        # While an OAM DMA transfer is running, OAM can't be read
+        self.oam_locked = False
+
+        # Tiles (0-383) whose data has been written since the GPU last
+        # decoded them
+        self.dirty_tiles: Set[int] = set(range(384))
+
+        # Whether the tile maps or OAM have changed since the GPU last
+        # drew a frame (tile data is covered by dirty_tiles)
+        self.video_changed = True
+
         # 16KB ROM bank 0
 
         # 16KB Switchable ROM bank
@@ -100,9 +246,42 @@ class RAM:
         # Interrupt Enabled Register
         self.data[0xFFFF] = 0x00  # IE
 
-        # TODO: ram[E000-FE00] mirrors ram[C000-DE00]
-
-    def get_boot(self) -> List[int]:
+        # One entry for each 256-byte page of the address space - a
+        # buffer and the base address which the page starts at, so that
+        # `ram[addr]` is `buf[addr - base]`. Pages that need more than
+        # that get a Handler as their buffer. Switching banks only
+        # needs to update the entries for the banked pages.
+        self._ext_ram_handler = Handler(self._read_ext_ram, self._write_ext_ram)
+        self._code_page = CodePage(self)
+        mbc = Handler(self.data.__getitem__, self._write_mbc)
+        data: Tuple[Any, int] = (self.data, 0)
+        self.read_pages: List[Tuple[Any, int]] = [data] * 0x100
+        self.write_pages: List[Tuple[Any, int]] = [data] * 0x100
+        for page in range(0x00, 0x80):
+            self.read_pages[page] = (self.rom, 0)
+            self.write_pages[page] = (mbc, 0)
+        tiles = TilePage(self)
+        for page in range(0x80, 0x98):
+            self.write_pages[page] = (tiles, 0)
+        video = VideoPage(self)
+        for page in range(0x98, 0xA0):
+            self.write_pages[page] = (video, 0)
+        for page in range(0xE0, 0xFE):
+            # ram[E000-FE00] mirrors ram[C000-DE00]
+            self.read_pages[page] = (self.data, 0x2000)
+            self.write_pages[page] = (self.data, 0x2000)
+        self.read_pages[0xFE] = (Handler(self._read_oam, self._write_oam), 0)
+        if self.debug:
+            self.write_pages[0xFE] = self.read_pages[0xFE]
+        else:
+            self.write_pages[0xFE] = (video, 0)
+        self.read_pages[0xFF] = (IOPage(self), 0)
+        self.write_pages[0xFF] = self.read_pages[0xFF]
+        self.io_write_hooks[Mem.BOOT] = self._write_boot
+        self._map_rom()
+        self._map_ext_ram()
+
+    def get_boot(self) -> bytes:
         try:
             # boot with the logo scroll if we have a boot rom
             with open("boot.gb", "rb") as fp:
@@ -149,71 +328,116 @@ class RAM:
             BOOT += [0xE0, 0x50]  # LDH 50,A (disable boot rom)
 
         assert len(BOOT) == 0x100, f"Bootloader must be 256 bytes ({len(BOOT)})"
-        return BOOT
-
-    def __getitem__(self, addr: int) -> int:
-        if addr < 0x4000:
-            # ROM bank 0
-            if self.data[Mem.BOOT] == 0 and addr < 0x100:
-                return self.boot[addr]
-            return self.cart.data[addr]
-        elif addr < 0x8000:
-            # Switchable ROM bank
-            # TODO: array bounds check
-            offset = addr - 0x4000
-            bank = self.rom_bank * ROM_BANK_SIZE
-            return self.cart.data[bank + offset]
-        elif addr < 0xA000:
-            # VRAM
-            pass
-        elif addr < 0xC000:
-            # 8KB Switchable RAM bank
-            if not self.ram_enable:
-                raise Exception(
-                    "Reading from external ram while disabled: {:04X}", addr
-                )
-            bank = self.ram_bank * RAM_BANK_SIZE
-            offset = addr - 0xA000
-            if bank + offset >= self.cart.ram_size:
-                # this should never happen because we die on ram_bank being
-                # set to a too-large value
-                raise Exception(
-                    "Reading from external ram beyond limit: {:04x} ({:02x}:{:04x})",
-                    bank + offset,
-                    self.ram_bank,
-                    offset,
-                )
-            return self.cart.ram[bank + offset]
-        elif addr < 0xD000:
-            # work RAM, bank 0
-            pass
-        elif addr < 0xE000:
-            # work RAM, bankable in CGB
-            pass
-        elif addr < 0xFE00:
-            # ram[E000-FE00] mirrors ram[C000-DE00]
-            return self.data[addr - 0x2000]
-        elif addr < 0xFEA0:
-            # Sprite attribute table
-            pass
-        elif addr < 0xFF00:
-            # Unusable
-            return 0xFF
-        elif addr < 0xFF80:
-            # IO Registers
-            pass
-        elif addr < 0xFFFF:
-            # High RAM
-            pass
+        return bytes(BOOT)
+
+    # <editor-fold description="Page Table">
+    def _map_rom(self) -> None:
+        """
+        Point the ROM pages at the boot ROM / bank 0 / the selected bank
+        """
+        if self.data[Mem.BOOT] == 0:
+            self.read_pages[0x00] = (self.boot, 0)
+        else:
+            self.read_pages[0x00] = (self.rom, 0)
+        entry = (self.rom_bank_view(self.rom_bank), 0x4000)
+        for page in range(0x40, 0x80):
+            self.read_pages[page] = entry
+
+    def rom_bank_view(self, bank: int) -> memoryview:
+        """
+        A 16KB window onto the cart ROM - no copying involved
+        """
+        return self.rom[bank * ROM_BANK_SIZE : (bank + 1) * ROM_BANK_SIZE]
+
+    def _map_ext_ram(self) -> None:
+        """
+        Point the external RAM pages at the selected bank - or if the
+        bank is disabled / doesn't exist, at the handler which complains
+        """
+        bank = self.ram_bank * RAM_BANK_SIZE
+        if self.ram_enable and bank + RAM_BANK_SIZE <= len(self.cart.ram):
+            entry = (self.cart_ram[bank : bank + RAM_BANK_SIZE], 0xA000)
         else:
-            # IE Register
-            pass
+            entry = (self._ext_ram_handler, 0)
+        for page in range(0xA0, 0xC0):
+            self.read_pages[page] = entry
+            self.write_pages[page] = entry
+
+    def watch_code(self, start: int, end: int) -> None:
+        """
+        Mark `start:end` as having been compiled, so that writing to it
+        calls `code_write_hook`
+        """
+        self.code_ranges[start] = end
+        for addr in range(start, end):
+            self.code_map[addr] += 1
+        for page in range(start >> 8, ((end - 1) >> 8) + 1):
+            if 0xC0 <= page < 0xE0:
+                self.write_pages[page] = (self._code_page, 0)
+                if page < 0xDE:
+                    self.write_pages[page + 0x20] = (self._code_page, 0x2000)
+
+    def unwatch_code(self, start: int) -> None:
+        """
+        Forget about the compiled range starting at `start` - pages with
+        no compiled code left on them go back to being written directly
+        """
+        end = self.code_ranges.pop(start)
+        for addr in range(start, end):
+            self.code_map[addr] -= 1
+        for page in range(start >> 8, ((end - 1) >> 8) + 1):
+            if 0xC0 <= page < 0xE0 and not any(
+                self.code_map[page << 8 : (page + 1) << 8]
+            ):
+                self.write_pages[page] = (self.data, 0)
+                if page < 0xDE:
+                    self.write_pages[page + 0x20] = (self.data, 0x2000)
+
+    def code_at(self, addr: int) -> List[int]:
+        """
+        The starts of the compiled ranges which cover `addr`
+        """
+        return [start for start, end in self.code_ranges.items() if start <= addr < end]
+
+    def read_range(self, addr: int, length: int) -> bytes:
+        """
+        Read `length` bytes starting at `addr` - as a single slice if
+        they're all within one plain page, else one byte at a time
+        """
+        buf, base = self.read_pages[addr >> 8]
+        if (addr + length - 1) >> 8 == addr >> 8 and isinstance(
+            buf, (bytes, bytearray, memoryview)
+        ):
+            return bytes(buf[addr - base : addr - base + length])
+        return bytes(self[a & 0xFFFF] for a in range(addr, addr + length))
+
+    def _write_boot(self, val: int) -> int:
+        self.data[Mem.BOOT] = val
+        self._map_rom()
+        return val
+
+    # </editor-fold>
+
+    # <editor-fold description="Page Handlers">
+    def _read_oam(self, addr: int) -> int:
+        if addr < 0xFEA0 and not self.oam_locked:
+            # Sprite attribute table
+            return self.data[addr]
+        # Unusable
+        return 0xFF
 
-        return self.data[addr]
+    def _write_oam(self, addr: int, val: int) -> None:
+        if addr >= 0xFEA0:
+            # Unusable
+            print("Writing to invalid ram: {:04x} = {:02x}", addr, val)
+        if self.data[addr] != val:
+            self.data[addr] = val
+            self.video_changed = True
 
-    def __setitem__(self, addr: int, val: int) -> None:
+    def _write_mbc(self, addr: int, val: int) -> None:
         if addr < 0x2000:
             self.ram_enable = val != 0
+            self._map_ext_ram()
         elif addr < 0x4000:
             self.rom_bank_low = val
             self.rom_bank = (self.rom_bank_high << 5) | self.rom_bank_low
@@ -225,6 +449,7 @@ class RAM:
                 )
             if self.rom_bank * ROM_BANK_SIZE > self.cart.rom_size:
                 raise Exception("Set rom_bank beyond the size of ROM")
+            self._map_rom()
         elif addr < 0x6000:
             if self.ram_bank_mode:
                 self.ram_bank = val
@@ -236,6 +461,7 @@ class RAM:
                     )
                 if self.ram_bank * RAM_BANK_SIZE > self.cart.ram_size:
                     raise Exception("Set ram_bank beyond the size of RAM")
+                self._map_ext_ram()
             else:
                 self.rom_bank_high = val
                 self.rom_bank = (self.rom_bank_high << 5) | self.rom_bank_low
@@ -247,65 +473,60 @@ class RAM:
                     )
                 if self.rom_bank * ROM_BANK_SIZE > self.cart.rom_size:
                     raise Exception("Set rom_bank beyond the size of ROM")
-        elif addr < 0x8000:
+                self._map_rom()
+        else:
             self.ram_bank_mode = val != 0
             if self.debug:
                 print("ram_bank_mode set to {}", self.ram_bank_mode)
-        elif addr < 0xA000:
-            # VRAM
-            # TODO: if writing to tile RAM, update tiles in Mem.class?
-            pass
-        elif addr < 0xC000:
-            # external RAM, bankable
-            if not self.ram_enable:
-                raise Exception(
-                    "Writing to external ram while disabled: {:04x}={:02x}", addr, val
-                )
-            bank = self.ram_bank * RAM_BANK_SIZE
-            offset = addr - 0xA000
-            if self.debug:
-                print(
-                    "Writing external RAM: {:04x}={:02x} ({:02x}:{:04x})",
-                    bank + offset,
-                    val,
-                    self.ram_bank,
-                    offset,
-                )
-            if bank + offset >= self.cart.ram_size:
-                raise Exception(
-                    "Writing to external ram beyond limit: {:04x} ({:02x}:{:04x})",
-                    bank + offset,
-                    self.ram_bank,
-                    offset,
-                )
-            self.cart.ram[bank + offset] = val
-        elif addr < 0xD000:
-            # work RAM, bank 0
-            pass
-        elif addr < 0xE000:
-            # work RAM, bankable in CGB
-            pass
-        elif addr < 0xFE00:
-            # ram[E000-FE00] mirrors ram[C000-DE00]
-            self.data[addr - 0x2000] = val
-        elif addr < 0xFEA0:
-            # Sprite attribute table
-            pass
-        elif addr < 0xFF00:
-            # Unusable
-            if self.debug:
-                print("Writing to invalid ram: {:04x} = {:02x}", addr, val)
-        elif addr < 0xFF80:
-            # IO Registers
-            # if addr == Mem.:SCX as u16 {
-            #     println!("LY = {}, SCX = {}", self.get(Mem.:LY), val);
-            # }
-            pass
-        elif addr < 0xFFFF:
-            # High RAM
-            pass
-        else:
-            # IE Register
-            pass
 
-        self.data[addr] = val
+    def _read_ext_ram(self, addr: int) -> int:
+        # 8KB Switchable RAM bank
+        if not self.ram_enable:
+            raise Exception("Reading from external ram while disabled: {:04X}", addr)
+        bank = self.ram_bank * RAM_BANK_SIZE
+        offset = addr - 0xA000
+        if bank + offset >= self.cart.ram_size:
+            # this should never happen because we die on ram_bank being
+            # set to a too-large value
+            raise Exception(
+                "Reading from external ram beyond limit: {:04x} ({:02x}:{:04x})",
+                bank + offset,
+                self.ram_bank,
+                offset,
+            )
+        return self.cart.ram[bank + offset]
+
+    def _write_ext_ram(self, addr: int, val: int) -> None:
+        # external RAM, bankable
+        if not self.ram_enable:
+            raise Exception(
+                "Writing to external ram while disabled: {:04x}={:02x}", addr, val
+            )
+        bank = self.ram_bank * RAM_BANK_SIZE
+        offset = addr - 0xA000
+        if self.debug:
+            print(
+                "Writing external RAM: {:04x}={:02x} ({:02x}:{:04x})",
+                bank + offset,
+                val,
+                self.ram_bank,
+                offset,
+            )
+        if bank + offset >= self.cart.ram_size:
+            raise Exception(
+                "Writing to external ram beyond limit: {:04x} ({:02x}:{:04x})",
+                bank + offset,
+                self.ram_bank,
+                offset,
+            )
+        self.cart.ram[bank + offset] = val
+
+    # </editor-fold>
+
+    def __getitem__(self, addr: int) -> int:
+        buf, base = self.read_pages[addr >> 8]
+        return buf[addr - base]
+
+    def __setitem__(self, addr: int, val: int) -> None:
+        buf, base = self.write_pages[addr >> 8]
+        buf[addr - base] = val